@@ -1,10 +1,9 @@
 """LINE Bot 題目練習應用程式，提供多題庫練習、即時回饋和答題統計功能。"""
 
-import asyncio
+import atexit
 import base64
 import hashlib
 import hmac
-import json
 import logging
 import os
 import random
@@ -12,30 +11,96 @@ from datetime import datetime
 
 from dotenv import find_dotenv, load_dotenv
 from flask import Flask, request
-from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    ApiClient,
-    AsyncApiClient,
-    AsyncMessagingApi,
     Configuration,
     FlexContainer,
     FlexMessage,
-    MessagingApi,
     ReplyMessageRequest,
-    ShowLoadingAnimationRequest,
     TextMessage,
 )
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
+from compaction import CompactionScheduler
 from database import Database
 from flask_logs import LogSetup
+from flex_templates import FlexTemplateCache
+from line_client import AsyncLineClient, BackgroundEventLoop, LineClient
+from question_bank import question_banks
+from reply_cache import ReplyPayloadCache
+from session_store import UserSession, create_session_store
+from sharded_database import ShardedDatabase
+from user_state_cache import UserStateCache
+from webhook_worker import DispatchingWebhookHandler, KeyedExecutor, WebhookWorkerPool
 
 load_dotenv(find_dotenv())
 access_token = os.getenv("ACCESS_TOKEN")
 secret = os.getenv("SECRET")
 configuration = Configuration(access_token=access_token)
-handler = WebhookHandler(secret)
+
+# 同一個 webhook 請求中不同使用者的事件平行處理，同一個使用者的事件依序處理
+handler = DispatchingWebhookHandler(
+    secret,
+    executor=KeyedExecutor(
+        int(os.environ.get("WEBHOOK_DISPATCH_WORKERS", 8)),
+        thread_name_prefix="webhook-dispatch",
+    ),
+)
+
+# 快速回應模式：WEBHOOK_ASYNC_ACK=true 時 callback 只驗證簽章並把事件放進佇列，
+# 立即回應 200，由背景工作執行緒處理事件
+webhook_workers = None
+if os.environ.get("WEBHOOK_ASYNC_ACK", "false").lower() == "true":
+    webhook_workers = WebhookWorkerPool(
+        handler,
+        workers=int(os.environ.get("WEBHOOK_WORKERS", 8)),
+        max_queue=int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000)),
+    )
+    webhook_workers.start()
+
+# 每個行程共用的 LINE API 連線池大小，未設定時使用 SDK 預設值
+line_pool_size = os.environ.get("LINE_POOL_SIZE")
+line_pool_size = int(line_pool_size) if line_pool_size else None
+
+# 行程內共用、保持 keep-alive 的同步 LINE 用戶端（用於所有回覆）
+line_client = LineClient(configuration, pool_size=line_pool_size)
+
+# 行程內共用的背景 event loop 與非同步 LINE 用戶端（用於 loading animation）
+event_loop = BackgroundEventLoop()
+async_line_client = AsyncLineClient(configuration, event_loop, pool_size=line_pool_size)
+
+# 回覆超過這個秒數還沒準備好時才顯示 loading animation
+LOADING_ANIMATION_DELAY = float(os.environ.get("LOADING_ANIMATION_DELAY", 0.5))
+
+
+_shut_down = False
+
+
+@atexit.register
+def shutdown():
+    """處理完佇列中的事件後，關閉共用的 LINE 用戶端、資料庫連線與背景 event loop
+
+    gunicorn 的 worker_exit 與行程結束時的 atexit 都會呼叫，只有第一次會執行。
+    """
+    global _shut_down
+    if _shut_down:
+        return
+    _shut_down = True
+    try:
+        if webhook_workers is not None:
+            webhook_workers.shutdown(
+                timeout=float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", 30))
+            )
+        # 先寫入佇列中的答題記錄，再關閉 LINE 用戶端
+        if compaction is not None:
+            compaction.stop()
+        db.close()
+        sessions.close()
+        line_client.close()
+        async_line_client.close()
+    finally:
+        event_loop.stop()
+
 
 app = Flask(__name__)
 
@@ -51,14 +116,42 @@ app.config["LOG_COPIES"] = os.environ.get("LOG_COPIES", 5)
 logs = LogSetup()
 logs.init_app(app)
 
-# 定義全局變量
-current_question = None
-current_question_data = None  # 用於存儲完整的題目數據
-current_database = None  # 用於追踪當前題庫
-user_selections = {}  # 添加全局變量來儲存用戶選擇
-user_question_options = {}  # 添加全局變量來儲存每個用戶的題目選項順序
-user_current_question = {}  # user_id: 正確答案
-user_current_question_data = {}  # user_id: 題目完整資料
+# Flex 模板快取，設定 TEMPLATE_AUTO_RELOAD=true 時會在模板檔案變動後自動重新載入
+flex_templates = FlexTemplateCache(
+    auto_reload=os.environ.get("TEMPLATE_AUTO_RELOAD", "false").lower() == "true"
+)
+
+# 各模板在產生訊息時會被修改的路徑，只有這些路徑上的容器需要複製
+TOPIC_TEMPLATE_PATHS = (
+    ("body", "contents", 0),
+    ("body", "contents", 1),
+    ("footer", "contents", 0, "contents", 0),
+    ("footer", "contents", 0, "contents", 1),
+)
+ANSWER_TEMPLATE_PATHS = (
+    ("body", "contents", 0),
+    ("body", "contents", 2),
+    ("body", "contents", 3, "contents", 1),
+)
+STATISTICS_TEMPLATE_PATHS = (
+    ("body", "contents", 1),
+    ("body", "contents", 2, "contents", "*", "contents", 1),
+)
+
+# 每位使用者的答題狀態（目前題庫、題目、選項順序與多選題的選擇）
+# 執行多個 worker 行程時設定 SESSION_BACKEND=sqlite，讓所有行程共用答題狀態
+session_backend = os.environ.get("SESSION_BACKEND", "memory")
+session_options = dict(
+    max_sessions=int(os.environ.get("SESSION_MAX_USERS", 10000)),
+    idle_ttl=float(os.environ.get("SESSION_IDLE_TTL", 1800)),
+)
+if session_backend == "sqlite":
+    session_options["db_file"] = os.environ.get("SESSION_DB", "sessions.db")
+else:
+    session_options["max_bytes"] = (
+        int(os.environ.get("SESSION_MAX_MB", 64)) * 1024 * 1024
+    )
+sessions = create_session_store(session_backend, **session_options)
 
 
 @app.after_request
@@ -81,150 +174,273 @@ def after_request(response):
 
 
 # 初始化數據庫
-db = Database()
+db_options = dict(
+    busy_timeout=int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)),
+    cache_size=int(os.environ.get("SQLITE_CACHE_SIZE", -16000)),
+    write_behind=os.environ.get("DB_WRITE_BEHIND", "false").lower() == "true",
+    flush_interval=int(os.environ.get("DB_FLUSH_INTERVAL_MS", 50)) / 1000,
+    flush_batch=int(os.environ.get("DB_FLUSH_BATCH", 500)),
+)
+# DB_SHARDS 大於 1 時依使用者分散到多個資料庫檔案
+db_shards = int(os.environ.get("DB_SHARDS", 1))
+if db_shards > 1:
+    db = ShardedDatabase(shards=db_shards, **db_options)
+else:
+    db = Database(**db_options)
+
+# 使用者目前題庫的快取，題庫沒有改變時不必每一題都寫入資料庫
+user_states = UserStateCache(
+    db,
+    max_entries=int(os.environ.get("USER_STATE_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("USER_STATE_TTL", 300)),
+    touch_interval=float(os.environ.get("USER_STATE_TOUCH_INTERVAL", 600)),
+)
+
+# 定期把超過保存期限的答題記錄壓縮成摘要（也可以用 manage.py compact 手動執行）
+compaction = None
+if float(os.environ.get("COMPACTION_INTERVAL_HOURS", 0)) > 0:
+    compaction = CompactionScheduler(
+        db,
+        float(os.environ["COMPACTION_INTERVAL_HOURS"]) * 3600,
+        # 多個 worker 行程中只有一個會執行壓縮
+        lock_file=f"{db.db_file}.compaction.lock",
+        retention_days=int(os.environ.get("ANSWER_RETENTION_DAYS", 180)),
+    )
+    compaction.start()
+
+
+# 固定內容回覆的預先序列化快取
+reply_payloads = ReplyPayloadCache()
+
+
+class Reply:
+    """準備好的回覆內容
+
+    messages 為 SDK 訊息列表；固定內容的回覆則以 cache_key 指向
+    預先序列化的快取，第一次送出時才呼叫 build_messages 建立訊息。
+    """
+
+    __slots__ = ("messages", "cache_key", "build_messages", "source")
+
+    def __init__(self, messages=None, cache_key=None, build_messages=None, source=None):
+        self.messages = messages
+        self.cache_key = cache_key
+        self.build_messages = build_messages
+        self.source = source
+
+
+def flex_reply(alt_text, flex_content):
+    """Flex Message 回覆"""
+    return Reply(
+        messages=[
+            FlexMessage(
+                alt_text=alt_text, contents=FlexContainer.from_dict(flex_content)
+            )
+        ]
+    )
+
+
+def text_reply(text):
+    """固定的文字回覆，重複的內容直接使用已序列化的請求"""
+    return Reply(
+        cache_key=("text", text), build_messages=lambda: [TextMessage(text=text)]
+    )
+
+
+def database_list_reply(flex_content, alt_text, prompt=None):
+    """題庫選擇列表回覆，分頁內容沒有變動時直接使用已序列化的請求"""
+
+    def build_messages():
+        messages = [
+            FlexMessage(
+                alt_text=alt_text, contents=FlexContainer.from_dict(flex_content)
+            )
+        ]
+        if prompt:
+            messages.insert(0, TextMessage(text=prompt))
+        return messages
+
+    return Reply(
+        cache_key=("database_list", id(flex_content), alt_text, prompt),
+        build_messages=build_messages,
+        source=flex_content,
+    )
+
+
+def send_reply(line_bot_api, reply_token, reply):
+    """送出準備好的回覆"""
+    if reply.cache_key is not None:
+        reply_payloads.reply(
+            line_bot_api.api_client,
+            reply_token,
+            reply.cache_key,
+            reply.build_messages,
+            source=reply.source,
+        )
+    else:
+        line_bot_api.reply_message_with_http_info(
+            ReplyMessageRequest(reply_token=reply_token, messages=reply.messages)
+        )
+
+
+# 題庫列表分頁快取：(題庫目錄簽章, 各頁 carousel)
+database_pages_cache = (None, ())
 
 
 def create_database_flex_message(page=1):
     """創建題庫選擇的 Flex Message
     Args:
         page (int): 當前頁碼，從1開始
+    Returns:
+        快取中共用的 carousel，呼叫端不可修改；題庫目錄內容變動時才會重新產生
     """
+    global database_pages_cache
+
     try:
-        # 讀取基本模板
-        with open("templates/database_flex_message.json", "r", encoding="utf-8") as f:
-            flex_message = json.load(f)
+        signature = question_banks.directory_signature()
+        cached_signature, pages = database_pages_cache
+        if cached_signature != signature:
+            pages = build_database_pages(question_banks.list_banks())
+            database_pages_cache = (signature, pages)
 
-        # 獲取 database 資料夾中的所有 json 文件
-        database_files = [f for f in os.listdir("database") if f.endswith(".json")]
+        # 確保頁碼有效
+        page = max(1, min(page, len(pages)))
+        return pages[page - 1]
 
-        # 計算分頁資訊
-        items_per_page = 10  # 每頁顯示10個題庫
-        total_pages = (len(database_files) + items_per_page - 1) // items_per_page
+    except Exception as e:
+        print(f"Error creating database flex message: {e}")
+        return None
 
-        # 確保頁碼有效
-        page = max(1, min(page, total_pages))
-
-        # 計算當前頁的題庫
-        start_idx = (page - 1) * items_per_page
-        end_idx = start_idx + items_per_page
-        current_page_files = database_files[start_idx:end_idx]
-
-        # 創建題庫氣泡列表
-        bubbles = []
-        for db_file in current_page_files:
-            # 移除 .json 副檔名，作為題庫名稱
-            db_name = db_file[:-5]
-
-            # 將 _multi 替換為 _多選
-            display_name = db_name.replace("_multi", "_多選")
-
-            # 如果題庫名稱太長，截斷它
-            if len(display_name) > 20:  # 為了在氣泡中顯示得更好
-                display_name = display_name[:17] + "..."
-
-            bubble = {
-                "type": "bubble",
-                "size": "micro",
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "spacing": "sm",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": display_name,
-                            "weight": "bold",
-                            "size": "md",
-                            "wrap": True,
-                            "align": "center",
-                        },
-                        {
-                            "type": "button",
-                            "style": "primary",
-                            "color": "#5A8DEE",
-                            "action": {
-                                "type": "message",
-                                "label": "開始練習",
-                                "text": f"切換到 {db_name}",
-                            },
-                        },
-                    ],
-                },
-            }
-            bubbles.append(bubble)
 
-        # 添加分頁控制氣泡
-        if total_pages > 1:
-            navigation_contents = [
-                {
-                    "type": "text",
-                    "text": f"第 {page}/{total_pages} 頁",
-                    "weight": "bold",
-                    "size": "sm",
-                    "align": "center",
-                }
-            ]
+def build_database_pages(database_names):
+    """依題庫名稱列表產生所有分頁的 carousel"""
+    # 計算分頁資訊
+    items_per_page = 10  # 每頁顯示10個題庫
+    total_pages = (len(database_names) + items_per_page - 1) // items_per_page
 
-            # 上一頁按鈕
-            if page > 1:
-                navigation_contents.append(
-                    {
-                        "type": "button",
-                        "style": "secondary",
-                        "action": {
-                            "type": "message",
-                            "label": "上一頁",
-                            "text": f"題庫列表 {page - 1}",
-                        },
-                    }
-                )
+    return tuple(
+        build_database_page(database_names, page, total_pages, items_per_page)
+        for page in range(1, max(total_pages, 1) + 1)
+    )
+
+
+def build_database_page(database_names, page, total_pages, items_per_page):
+    """產生單一頁的題庫選擇 carousel"""
+    # 讀取基本模板
+    flex_message = flex_templates.get("database_flex_message.json")
+
+    # 計算當前頁的題庫
+    start_idx = (page - 1) * items_per_page
+    end_idx = start_idx + items_per_page
+    current_page_names = database_names[start_idx:end_idx]
+
+    # 創建題庫氣泡列表
+    bubbles = []
+    for db_name in current_page_names:
+        # 將 _multi 替換為 _多選
+        display_name = db_name.replace("_multi", "_多選")
+
+        # 如果題庫名稱太長，截斷它
+        if len(display_name) > 20:  # 為了在氣泡中顯示得更好
+            display_name = display_name[:17] + "..."
 
-            # 下一頁按鈕
-            if page < total_pages:
-                navigation_contents.append(
+        bubble = {
+            "type": "bubble",
+            "size": "micro",
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "spacing": "sm",
+                "contents": [
+                    {
+                        "type": "text",
+                        "text": display_name,
+                        "weight": "bold",
+                        "size": "md",
+                        "wrap": True,
+                        "align": "center",
+                    },
                     {
                         "type": "button",
-                        "style": "secondary",
+                        "style": "primary",
+                        "color": "#5A8DEE",
                         "action": {
                             "type": "message",
-                            "label": "下一頁",
-                            "text": f"題庫列表 {page + 1}",
+                            "label": "開始練習",
+                            "text": f"切換到 {db_name}",
                         },
-                    }
-                )
-
-            navigation_bubble = {
-                "type": "bubble",
-                "size": "micro",
-                "body": {
-                    "type": "box",
-                    "layout": "vertical",
-                    "spacing": "sm",
-                    "contents": navigation_contents,
-                },
+                    },
+                ],
+            },
+        }
+        bubbles.append(bubble)
+
+    # 添加分頁控制氣泡
+    if total_pages > 1:
+        navigation_contents = [
+            {
+                "type": "text",
+                "text": f"第 {page}/{total_pages} 頁",
+                "weight": "bold",
+                "size": "sm",
+                "align": "center",
             }
+        ]
 
-            bubbles.append(navigation_bubble)
+        # 上一頁按鈕
+        if page > 1:
+            navigation_contents.append(
+                {
+                    "type": "button",
+                    "style": "secondary",
+                    "action": {
+                        "type": "message",
+                        "label": "上一頁",
+                        "text": f"題庫列表 {page - 1}",
+                    },
+                }
+            )
 
-        # 更新 carousel 內容
-        flex_message["contents"] = bubbles
-        return flex_message
+        # 下一頁按鈕
+        if page < total_pages:
+            navigation_contents.append(
+                {
+                    "type": "button",
+                    "style": "secondary",
+                    "action": {
+                        "type": "message",
+                        "label": "下一頁",
+                        "text": f"題庫列表 {page + 1}",
+                    },
+                }
+            )
 
-    except Exception as e:
-        print(f"Error creating database flex message: {e}")
-        return None
+        navigation_bubble = {
+            "type": "bubble",
+            "size": "micro",
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "spacing": "sm",
+                "contents": navigation_contents,
+            },
+        }
+
+        bubbles.append(navigation_bubble)
+
+    # 更新 carousel 內容
+    flex_message["contents"] = bubbles
+    return flex_message
 
 
 def get_question(database_name=None):
     """從指定題庫或預設題庫中讀取隨機題目"""
     try:
-        file_path = (
-            f"database/{database_name}.json" if database_name else "questions.json"
-        )
-        with open(file_path, "r", encoding="utf-8") as f:
-            questions_data = json.load(f)
-            questions = questions_data["questions"]
-            return random.choice(questions)
+        if database_name:
+            bank = question_banks.get(database_name)
+        else:
+            bank = question_banks.get_file("questions.json")
+        return bank.random_question()
     except Exception as e:
         print(f"Error reading questions: {e}")
         return None
@@ -235,30 +451,18 @@ def is_multi_choice_db(database_name):
     return database_name.endswith("multi")
 
 
-def create_flex_message(
-    question_data, selected_options=None, user_id=None, is_multi=False
-):
+def create_flex_message(question_data, selected_options, session, is_multi=False):
     """創建 Flex Message，保持ABCD順序不變，但選項內容隨機排序
     Args:
         question_data: 題目數據
         selected_options: 已選擇的選項集合
-        user_id: 用戶ID，用於追踪選項順序
+        session: 使用者的答題狀態，用於保存打亂後的題目與選項順序
         is_multi: 是否為多選題
     """
-    global current_question, current_question_data, user_question_options
 
     # 根據題目類型選擇不同的模板文件
-    template_file = (
-        "templates/multi_flex_message.json"
-        if is_multi
-        else "templates/topic_flex_message.json"
-    )
-    with open(template_file, "r", encoding="utf-8") as f:
-        flex_message = json.load(f)
-
-    # 保存當前題目數據
-    current_question = question_data["answer"]  # 這裡可能是單個字母或多個字母的字符串
-    current_question_data = question_data
+    template_file = "multi_flex_message.json" if is_multi else "topic_flex_message.json"
+    flex_message = flex_templates.get(template_file, TOPIC_TEMPLATE_PATHS)
 
     # 設置題目文字（如果太長則截斷）
     question_text = question_data["question_text"]
@@ -269,13 +473,13 @@ def create_flex_message(
     # 檢查是否已有固定的選項順序
     if (
         is_multi
-        and user_id
-        and user_id in user_question_options
-        and question_data["id"] == user_question_options[user_id]["id"]
+        and session.options is not None
+        and session.question_data is not None
+        and question_data["id"] == session.question_data["id"]
     ):
         # 使用已存在的選項順序
-        new_options = user_question_options[user_id]["options"]
-        current_question = user_question_options[user_id]["answer"]
+        new_options = session.options
+        answer = session.answer
     else:
         # 首次顯示題目，隨機排序選項
         options = list(question_data["options"].values())  # 獲取選項內容列表
@@ -295,21 +499,17 @@ def create_flex_message(
                 if option == question_data["options"][original_answer]:
                     new_answers.append(char)
 
-        # 更新正確答案為新的字母組合
-        current_question = "".join(sorted(new_answers))
+        # 更新正確答案為新的字母組合，這裡可能是單個字母或多個字母的字符串
+        answer = "".join(sorted(new_answers))
 
         # 保存選項順序（僅多選題需要）
-        if is_multi and user_id:
-            user_question_options[user_id] = {
-                "id": question_data["id"],
-                "options": new_options,
-                "answer": current_question,
-            }
+        if is_multi:
+            session.options = new_options
 
     # 更新題目數據中的選項
-    current_question_data = question_data.copy()
-    current_question_data["options"] = new_options
-    current_question_data["answer"] = current_question
+    shuffled_question = question_data.copy()
+    shuffled_question["options"] = new_options
+    shuffled_question["answer"] = answer
 
     # 創建選項容器
     options_container = {
@@ -384,7 +584,9 @@ def create_flex_message(
     flex_message["body"]["contents"][3] = options_container
 
     # 獲取題目的作答統計
-    attempt_stats = db.get_question_attempt_stats(question_data["id"], current_database)
+    attempt_stats = db.get_question_attempt_stats(
+        question_data["id"], session.database_name
+    )
     print(f"Got attempt stats: {attempt_stats}")
 
     # 更新 footer 中的統計信息
@@ -403,9 +605,8 @@ def create_flex_message(
         else:
             print(f"Unexpected footer structure: {stats_box}")
 
-    if user_id:
-        user_current_question[user_id] = current_question
-        user_current_question_data[user_id] = current_question_data
+    session.question_data = shuffled_question
+    session.answer = answer
 
     return flex_message
 
@@ -414,8 +615,9 @@ def create_statistics_flex_message(user_id, database_name):
     """創建統計信息的 Flex Message"""
     try:
         # 讀取基本模板
-        with open("templates/statistics_flex_message.json", "r", encoding="utf-8") as f:
-            flex_message = json.load(f)
+        flex_message = flex_templates.get(
+            "statistics_flex_message.json", STATISTICS_TEMPLATE_PATHS
+        )
 
         # 獲取統計數據
         stats = db.get_user_statistics(user_id, database_name)
@@ -526,85 +728,74 @@ def create_statistics_flex_message(user_id, database_name):
         return None
 
 
-def send_question(reply_token, database_name=None, user_id=None, wrong_question=None):
-    """發送新題目"""
-    global current_database
+def prepare_question(database_name=None, session=None, wrong_question=None):
+    """準備新題目的回覆，並把題目記錄在使用者的答題狀態中"""
+    if session is None:
+        session = UserSession(None)
 
     try:
         # 如果沒有指定題庫名稱，使用當前題庫或第一個可用的題庫
         if database_name is None:
-            if current_database:
-                database_name = current_database
+            if session.database_name is None and session.user_id:
+                # 答題狀態已被移除時，沿用資料庫中記錄的題庫
+                session.database_name = user_states.get(session.user_id)
+            if session.database_name:
+                database_name = session.database_name
             else:
-                database_files = [
-                    f[:-5] for f in os.listdir("database") if f.endswith(".json")
-                ]
-                if not database_files:
+                database_names = question_banks.list_banks()
+                if not database_names:
                     raise FileNotFoundError("找不到任何題庫文件")
-                database_name = database_files[0]
+                database_name = database_names[0]
 
-        current_database = database_name
+        session.database_name = database_name
+        session.is_wrong_question_practice = wrong_question is not None
         is_multi = is_multi_choice_db(database_name)
 
         # 更新用戶當前題庫
-        if user_id:
-            db.update_user_state(user_id, database_name)
+        if session.user_id:
+            user_states.update(session.user_id, database_name)
 
         # 獲取題目
         if wrong_question:
-            question_data = wrong_question["question_data"]
+            # 優先使用題庫中最新的題目內容，題目已被移除時才使用作答當時的快照
+            try:
+                question_data = question_banks.get(database_name).get(
+                    wrong_question["question_id"]
+                )
+            except OSError:
+                question_data = None
+            if question_data is None:
+                question_data = wrong_question["question_data"]
         else:
             question_data = get_question(database_name)
 
         if not question_data:
             raise ValueError("無法從題庫中獲取題目")
 
-        # 清除用戶之前的選項順序
-        if user_id in user_question_options:
-            del user_question_options[user_id]
+        # 清除用戶之前的選項順序與選擇
+        session.options = None
+        session.selections = ""
 
         # 創建 Flex Message
-        flex_content = create_flex_message(question_data, set(), user_id, is_multi)
+        flex_content = create_flex_message(question_data, set(), session, is_multi)
         if not flex_content:
             raise ValueError("無法創建 Flex Message")
 
         flex_content["body"]["contents"][0]["text"] = f"📚 題庫：{database_name}"
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text=f"iPAS {database_name}題目",
-                            contents=FlexContainer.from_dict(flex_content),
-                        )
-                    ],
-                )
-            )
+        return flex_reply(f"iPAS {database_name}題目", flex_content)
 
     except Exception as e:
-        print(f"Error in send_question: {e}")
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        TextMessage(
-                            text="抱歉，讀取題目時發生錯誤。請稍後再試或切換其他題庫。"
-                        )
-                    ],
-                )
-            )
+        print(f"Error in prepare_question: {e}")
+        return text_reply("抱歉，讀取題目時發生錯誤。請稍後再試或切換其他題庫。")
 
 
 def create_answer_flex_message(question_data, selected_answer, is_correct):
     """創建答案回覆的 Flex Message"""
     try:
-        with open("templates/answer_flex_message.json", "r", encoding="utf-8") as f:
-            flex_message = json.load(f)
+        flex_message = flex_templates.get(
+            "answer_flex_message.json", ANSWER_TEMPLATE_PATHS
+        )
 
         # 設置答對/答錯的文字和顏色
         flex_message["body"]["contents"][0]["text"] = (
@@ -676,7 +867,23 @@ def callback():
             return "Bad Request", 400
 
         # 处理 webhook 请求
-        handler.handle(body, signature)
+        if webhook_workers is not None:
+            # 快速回應模式：事件放進佇列後立即回應，佇列已滿時回應 503 讓 LINE 重送
+            payload = handler.parser.parse(body, signature, as_payload=True)
+            if not webhook_workers.submit_all(payload.events, payload.destination):
+                extra = {
+                    "ip": ip,
+                    "method": method,
+                    "path": path,
+                    "status": 503,
+                    "size": 0,
+                }
+                logging.warning(
+                    "Webhook queue full: %s", webhook_workers.stats(), extra=extra
+                )
+                return "Service Unavailable", 503
+        else:
+            handler.handle(body, signature)
 
         # 记录成功请求
         extra = {
@@ -699,433 +906,237 @@ def callback():
         return "Server Error", 500
 
 
+def build_reply(message_text, session):
+    """依照收到的訊息處理使用者的答題狀態並準備回覆，不需要回覆時回傳 None"""
+    user_id = session.user_id
+
+    # 檢查當前是否為多選題庫
+    is_multi = session.database_name and is_multi_choice_db(session.database_name)
+
+    # 如果是選項選擇
+    if message_text.startswith("選擇 "):
+        # 從消息中提取選項（例如："選擇 A. 選項內容" -> "A"）
+        selected_answer = message_text.split(" ")[1].split(".")[0]
+
+        if not is_multi:
+            # 單選題直接檢查答案
+            if session.question_data is not None:
+                correct_answer = session.answer
+                question_data = session.question_data
+                is_correct = selected_answer == correct_answer
+
+                # 記錄答題
+                db.record_answer(
+                    user_id=user_id,
+                    question_data=question_data,
+                    user_answer=selected_answer,
+                    is_correct=is_correct,
+                    database_name=session.database_name,
+                    is_wrong_question_practice=session.is_wrong_question_practice,
+                )
+
+                # 清除
+                session.clear_question()
+                session.is_wrong_question_practice = False
+
+                # 顯示結果
+                result_flex = create_answer_flex_message(
+                    question_data, selected_answer, is_correct
+                )
+                if result_flex:
+                    return flex_reply("題目回顧", result_flex)
+            return None
+        else:
+            # 多選題只更新選擇，不做答題判斷
+            session.toggle_selection(selected_answer)
+
+            # 更新畫面
+            if session.question_data is not None:
+                flex_content = create_flex_message(
+                    session.question_data, set(session.selections), session, True
+                )
+                return flex_reply("選擇題選項", flex_content)
+            return None
+
+    # 如果是清除選擇（僅多選題可用）
+    elif message_text == "清除選擇" and is_multi:
+        session.selections = ""
+        if session.question_data is not None:
+            flex_content = create_flex_message(
+                session.question_data, set(), session, True
+            )
+            return flex_reply("選擇題選項", flex_content)
+        return None
+
+    # 如果是送出答案（僅多選題可用）
+    elif message_text == "送出答案" and is_multi:
+        if not session.selections:
+            return text_reply("請先選擇答案")
+
+        if session.question_data is not None:
+            correct_answer = session.answer
+            question_data = session.question_data
+            selected_answers = list(session.selections)
+
+            is_correct = len(selected_answers) == len(correct_answer) and all(
+                ans in correct_answer for ans in selected_answers
+            )
+
+            # 記錄答題
+            db.record_answer(
+                user_id=user_id,
+                question_data=question_data,
+                user_answer=",".join(selected_answers),
+                is_correct=is_correct,
+                database_name=session.database_name,
+                is_wrong_question_practice=session.is_wrong_question_practice,
+            )
+
+            # 重置錯題練習標記
+            session.is_wrong_question_practice = False
+
+            result_flex = create_answer_flex_message(
+                question_data, ",".join(selected_answers), is_correct
+            )
+
+            session.selections = ""
+            session.options = None
+
+            if result_flex:
+                return flex_reply("題目回顧", result_flex)
+        return None
+
+    # 如果是查看統計
+    elif message_text == "查看統計":
+        current_db = session.database_name or user_states.get(user_id)
+        if current_db:
+            stats_flex = create_statistics_flex_message(user_id, current_db)
+            return flex_reply("答題統計", stats_flex)
+        return text_reply("請先選擇題庫開始練習")
+
+    # 如果是練習錯題
+    elif message_text == "練習錯題":
+        current_db = session.database_name or user_states.get(user_id)
+        if current_db:
+            wrong_questions = db.get_wrong_questions(user_id, current_db)
+            if wrong_questions:
+                # 隨機選擇一道錯題，發送題目時標記為錯題練習
+                wrong_question = random.choice(wrong_questions)
+                return prepare_question(current_db, session, wrong_question)
+            return text_reply("目前沒有錯題記錄")
+        return text_reply("請先選擇題庫開始練習")
+
+    # 如果是切換題庫請求
+    elif message_text == "切換題庫":
+        flex_content = create_database_flex_message(page=1)
+        if flex_content:
+            return database_list_reply(flex_content, "選擇題庫")
+        return text_reply("抱歉，無法讀取題庫列表")
+
+    # 如果是題庫列表分頁請求
+    elif message_text.startswith("題庫列表 "):
+        try:
+            page = int(message_text.split(" ")[1])
+            flex_content = create_database_flex_message(page=page)
+            if flex_content:
+                return database_list_reply(flex_content, f"選擇題庫 - 第{page}頁")
+        except (ValueError, IndexError):
+            return text_reply("無效的頁碼")
+        return None
+
+    # 如果是選擇特定題庫
+    elif message_text.startswith("切換到 "):
+        database_name = message_text[4:]
+        return prepare_question(database_name, session)
+
+    # 如果是"下一題"請求
+    elif message_text == "下一題":
+        return prepare_question(session=session)
+
+    # 如果是其他消息，顯示題庫選擇
+    else:
+        flex_content = create_database_flex_message(page=1)
+        if flex_content:
+            return database_list_reply(
+                flex_content, "選擇題庫", prompt="請選擇要練習的題庫："
+            )
+        return text_reply("抱歉，無法讀取題庫列表")
+
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
     """處理收到的消息"""
-    global is_wrong_question_practice
+    user_id = event.source.user_id
+
+    # loading animation 與回覆準備同時進行，回覆在門檻時間內準備好時就不會送出
+    loading = async_line_client.start_loading_animation(
+        user_id, delay=LOADING_ANIMATION_DELAY
+    )
     try:
-        message_text = event.message.text
-        user_id = event.source.user_id
-
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-
-            # 檢查當前是否為多選題庫
-            is_multi = current_database and is_multi_choice_db(current_database)
-
-            # 如果是選項選擇
-            if message_text.startswith("選擇 "):
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                # 從消息中提取選項（例如："選擇 A. 選項內容" -> "A"）
-                selected_answer = message_text.split(" ")[1].split(".")[0]
-
-                if not is_multi:
-                    # 單選題直接檢查答案
-                    if (
-                        user_id in user_current_question
-                        and user_id in user_current_question_data
-                    ):
-                        correct_answer = user_current_question[user_id]
-                        question_data = user_current_question_data[user_id]
-                        is_correct = selected_answer == correct_answer
-
-                        # 記錄答題
-                        db.record_answer(
-                            user_id=user_id,
-                            question_data=question_data,
-                            user_answer=selected_answer,
-                            is_correct=is_correct,
-                            database_name=current_database,
-                            is_wrong_question_practice=getattr(
-                                globals(), "is_wrong_question_practice", False
-                            ),
-                        )
-
-                        # 清除
-                        del user_current_question[user_id]
-                        del user_current_question_data[user_id]
-
-                        # 顯示結果
-                        result_flex = create_answer_flex_message(
-                            question_data, selected_answer, is_correct
-                        )
-                        if result_flex:
-                            line_bot_api.reply_message_with_http_info(
-                                ReplyMessageRequest(
-                                    reply_token=event.reply_token,
-                                    messages=[
-                                        FlexMessage(
-                                            alt_text="題目回顧",
-                                            contents=FlexContainer.from_dict(
-                                                result_flex
-                                            ),
-                                        )
-                                    ],
-                                )
-                            )
-                    return
-                else:
-                    # 多選題只更新選擇，不做答題判斷
-                    if user_id not in user_selections:
-                        user_selections[user_id] = set()
-                    if selected_answer in user_selections[user_id]:
-                        user_selections[user_id].remove(selected_answer)
-                    else:
-                        user_selections[user_id].add(selected_answer)
-
-                    # 更新畫面
-                    if user_id in user_current_question_data:
-                        flex_content = create_flex_message(
-                            user_current_question_data[user_id],
-                            user_selections[user_id],
-                            user_id,
-                            True,
-                        )
-                        line_bot_api.reply_message_with_http_info(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[
-                                    FlexMessage(
-                                        alt_text="選擇題選項",
-                                        contents=FlexContainer.from_dict(flex_content),
-                                    )
-                                ],
-                            )
-                        )
-                    return
-
-            # 如果是清除選擇（僅多選題可用）
-            elif message_text == "清除選擇" and is_multi:
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                if user_id in user_selections:
-                    user_selections[user_id].clear()
-                    if user_id in user_current_question_data:
-                        flex_content = create_flex_message(
-                            user_current_question_data[user_id], set(), user_id, True
-                        )
-                        line_bot_api.reply_message_with_http_info(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[
-                                    FlexMessage(
-                                        alt_text="選擇題選項",
-                                        contents=FlexContainer.from_dict(flex_content),
-                                    )
-                                ],
-                            )
-                        )
-                    return
-
-            # 如果是送出答案（僅多選題可用）
-            elif message_text == "送出答案" and is_multi:
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                if user_id not in user_selections or not user_selections[user_id]:
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="請先選擇答案")],
-                        )
-                    )
-                    return
-
-                if (
-                    user_id in user_current_question
-                    and user_id in user_current_question_data
-                ):
-                    correct_answer = user_current_question[user_id]
-                    question_data = user_current_question_data[user_id]
-                    selected_answers = sorted(user_selections[user_id])
-
-                    is_correct = len(selected_answers) == len(correct_answer) and all(
-                        ans in correct_answer for ans in selected_answers
-                    )
-
-                    # 記錄答題
-                    db.record_answer(
-                        user_id=user_id,
-                        question_data=question_data,
-                        user_answer=",".join(selected_answers),
-                        is_correct=is_correct,
-                        database_name=current_database,
-                        is_wrong_question_practice=getattr(
-                            globals(), "is_wrong_question_practice", False
-                        ),
-                    )
-
-                    # 重置錯題練習標記
-                    if "is_wrong_question_practice" in globals():
-                        del is_wrong_question_practice
-
-                    result_flex = create_answer_flex_message(
-                        question_data, ",".join(selected_answers), is_correct
-                    )
-
-                    user_selections[user_id].clear()
-                    if user_id in user_question_options:
-                        del user_question_options[user_id]
-
-                    if result_flex:
-                        line_bot_api.reply_message_with_http_info(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[
-                                    FlexMessage(
-                                        alt_text="題目回顧",
-                                        contents=FlexContainer.from_dict(result_flex),
-                                    )
-                                ],
-                            )
-                        )
-                return
-
-            # 如果是查看統計
-            elif message_text == "查看統計":
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                current_db = db.get_user_state(user_id)
-                if current_db:
-                    stats_flex = create_statistics_flex_message(user_id, current_db)
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[
-                                FlexMessage(
-                                    alt_text="答題統計",
-                                    contents=FlexContainer.from_dict(stats_flex),
-                                )
-                            ],
-                        )
-                    )
-                else:
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="請先選擇題庫開始練習")],
-                        )
-                    )
-                return
-
-            # 如果是練習錯題
-            elif message_text == "練習錯題":
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                current_db = db.get_user_state(user_id)
-                if current_db:
-                    wrong_questions = db.get_wrong_questions(user_id, current_db)
-                    if wrong_questions:
-                        # 隨機選擇一道錯題
-                        wrong_question = random.choice(wrong_questions)
-                        # 發送題目時標記為錯題練習
-                        is_wrong_question_practice = True
-                        send_question(
-                            event.reply_token, current_db, user_id, wrong_question
-                        )
-                    else:
-                        line_bot_api.reply_message_with_http_info(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text="目前沒有錯題記錄")],
-                            )
-                        )
-                else:
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="請先選擇題庫開始練習")],
-                        )
-                    )
-                return
-
-            # 如果是切換題庫請求
-            elif message_text == "切換題庫":
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                flex_content = create_database_flex_message(page=1)
-                if flex_content:
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[
-                                FlexMessage(
-                                    alt_text="選擇題庫",
-                                    contents=FlexContainer.from_dict(flex_content),
-                                )
-                            ],
-                        )
-                    )
-                else:
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="抱歉，無法讀取題庫列表")],
-                        )
-                    )
-
-            # 如果是題庫列表分頁請求
-            elif message_text.startswith("題庫列表 "):
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                try:
-                    page = int(message_text.split(" ")[1])
-                    flex_content = create_database_flex_message(page=page)
-                    if flex_content:
-                        line_bot_api.reply_message_with_http_info(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[
-                                    FlexMessage(
-                                        alt_text=f"選擇題庫 - 第{page}頁",
-                                        contents=FlexContainer.from_dict(flex_content),
-                                    )
-                                ],
-                            )
-                        )
-                except (ValueError, IndexError):
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="無效的頁碼")],
-                        )
-                    )
-
-            # 如果是選擇特定題庫
-            elif message_text.startswith("切換到 "):
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                database_name = message_text[4:]
-                send_question(event.reply_token, database_name, user_id)
-
-            # 如果是"下一題"請求
-            elif message_text == "下一題":
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                send_question(event.reply_token, user_id=user_id)
-
-            # 如果是其他消息，顯示題庫選擇
-            else:
-                # 顯示 loading animation
-                async def show_loading():
-                    async_api_client = AsyncApiClient(configuration)
-                    async_line_bot_api = AsyncMessagingApi(async_api_client)
-                    await async_line_bot_api.show_loading_animation(
-                        ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=5)
-                    )
-
-                asyncio.run(show_loading())
-
-                flex_content = create_database_flex_message(page=1)
-                if flex_content:
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[
-                                TextMessage(text="請選擇要練習的題庫："),
-                                FlexMessage(
-                                    alt_text="選擇題庫",
-                                    contents=FlexContainer.from_dict(flex_content),
-                                ),
-                            ],
-                        )
-                    )
-                else:
-                    line_bot_api.reply_message_with_http_info(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text="抱歉，無法讀取題庫列表")],
-                        )
-                    )
+        # 讀取、修改與儲存使用者的答題狀態在同一個 update 中完成
+        reply = sessions.update(
+            user_id, lambda session: build_reply(event.message.text, session)
+        )
+    except Exception as e:
+        print(f"Error in handle_message: {str(e)}")
+        reply = text_reply("處理訊息時發生錯誤，請稍後再試")
+    finally:
+        loading.cancel()
+
+    if reply is None:
+        return
 
+    try:
+        send_reply(line_client.messaging_api, event.reply_token, reply)
     except Exception as e:
         print(f"Error in handle_message: {str(e)}")
         try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="處理訊息時發生錯誤，請稍後再試")],
-                    )
-                )
+            send_reply(
+                line_client.messaging_api,
+                event.reply_token,
+                text_reply("處理訊息時發生錯誤，請稍後再試"),
+            )
         except Exception as inner_e:
             print(f"Error sending error message: {str(inner_e)}")
 
 
+def warm_caches():
+    """預先載入題庫列表與模板，第一個請求就不需要等待讀取題庫目錄與模板檔案"""
+    create_database_flex_message()
+    for template_file in (
+        "topic_flex_message.json",
+        "multi_flex_message.json",
+        "answer_flex_message.json",
+        "statistics_flex_message.json",
+    ):
+        flex_templates.get(template_file)
+
+
+def use_database(database):
+    """替換產生回覆時使用的資料庫（async_app 改用 AsyncDatabase 的執行緒讀寫）"""
+    global db
+    db = database
+    user_states.db = database
+
+
+def startup():
+    """worker 行程開始接收請求前的準備：載入題庫列表與模板、啟動背景 event loop
+
+    資料庫在 import 時已經升級到最新版本。
+    """
+    warm_caches()
+    event_loop.start()
+
+
+def create_app():
+    """正式環境的進入點（gunicorn -c gunicorn.conf.py），初始化後回傳 WSGI 應用程式"""
+    startup()
+    return app
+
+
 if __name__ == "__main__":
+    # Flask 內建的開發伺服器，正式環境請使用 gunicorn（見 gunicorn.conf.py）
+    startup()
     port = int(os.environ.get("PORT", 8080))
     app.run(
         host="0.0.0.0",
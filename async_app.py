@@ -0,0 +1,217 @@
+"""選用的 asyncio webhook 處理路徑
+
+設定 ASYNC_WEBHOOK=true 後以 gunicorn -c gunicorn.conf.py 啟動（或直接執行 python async_app.py），
+callback 改由 aiohttp 處理。驗證簽章、載入動畫與回覆都是同一個 event loop 中的 coroutine，
+等待 LINE API 回應的對話只佔用 coroutine，不佔用執行緒。
+
+答題狀態的讀寫與回覆內容的產生仍是阻塞操作，每則訊息交給 DatabaseLane 的執行緒執行；
+其中答題記錄與統計的讀寫再交給 AsyncDatabase 的單一寫入執行緒與讀取執行緒。
+題目、統計與回覆內容沿用 app.py 的函式產生，兩條路徑的回覆完全相同。
+"""
+
+import asyncio
+import logging
+import os
+import ssl
+
+from aiohttp import web
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import ReplyMessageRequest
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+import app as bot
+from async_database import AsyncDatabase, BlockingDatabase, DatabaseLane
+from line_client import AsyncLineClient
+from webhook_worker import DispatchingWebhookHandler, event_key
+
+# 註冊 coroutine 處理函式的 handler，用來驗證簽章、解析事件與找出處理函式
+handler = DispatchingWebhookHandler(bot.secret)
+
+# 直接在 aiohttp 的 event loop 中使用的 LINE 用戶端（載入動畫與回覆共用連線池）
+line_client = AsyncLineClient(bot.configuration, pool_size=bot.line_pool_size)
+
+# 執行答題狀態與資料庫讀寫的執行緒，超過 max_pending 的訊息在 event loop 中等待
+state_lane = DatabaseLane(
+    "message-handler",
+    workers=int(os.environ.get("ASYNC_DB_WORKERS", 8)),
+    max_pending=int(os.environ.get("ASYNC_DB_MAX_PENDING", 1000)),
+)
+
+# 答題記錄與統計的讀寫：寫入依序執行，讀取平行執行
+database = AsyncDatabase(
+    bot.db,
+    readers=int(os.environ.get("ASYNC_DB_READERS", 4)),
+    max_pending=int(os.environ.get("ASYNC_DB_MAX_PENDING", 1000)),
+)
+
+# 每位使用者最後一個尚未處理完的事件，只保留處理中的使用者
+_user_tails = {}
+
+
+async def send_reply_async(reply_token, reply):
+    """送出準備好的回覆（send_reply 的 coroutine 版本）"""
+    api = await line_client.get_api()
+    if reply.cache_key is not None:
+        await bot.reply_payloads.reply_async(
+            api.api_client,
+            reply_token,
+            reply.cache_key,
+            reply.build_messages,
+            reply.source,
+        )
+    else:
+        await api.reply_message(
+            ReplyMessageRequest(reply_token=reply_token, messages=reply.messages)
+        )
+
+
+async def update_session(user_id, fn):
+    """在執行緒中讀取使用者的答題狀態、呼叫 fn(session) 修改並儲存，回傳 fn 的結果"""
+    # 答題記錄一旦開始寫入就必須完成，不隨 webhook 請求取消
+    return await state_lane.call(bot.sessions.update, user_id, fn, shield=True)
+
+
+@handler.add(MessageEvent, message=TextMessageContent)
+async def handle_message_async(event):
+    """處理收到的消息（handle_message 的 coroutine 版本）"""
+    user_id = event.source.user_id
+
+    # loading animation 與回覆準備同時進行，回覆在門檻時間內準備好時就不會送出
+    loading = line_client.start_loading_animation(
+        user_id, delay=bot.LOADING_ANIMATION_DELAY
+    )
+    try:
+        reply = await update_session(
+            user_id, lambda session: bot.build_reply(event.message.text, session)
+        )
+    except Exception as e:
+        print(f"Error in handle_message_async: {str(e)}")
+        reply = bot.text_reply("處理訊息時發生錯誤，請稍後再試")
+    finally:
+        loading.cancel()
+
+    if reply is None:
+        return
+
+    try:
+        await send_reply_async(event.reply_token, reply)
+    except Exception as e:
+        print(f"Error in handle_message_async: {str(e)}")
+        try:
+            await send_reply_async(
+                event.reply_token, bot.text_reply("處理訊息時發生錯誤，請稍後再試")
+            )
+        except Exception as inner_e:
+            print(f"Error sending error message: {str(inner_e)}")
+
+
+async def _dispatch(event, previous):
+    if previous is not None:
+        # 等待同一位使用者的前一個事件處理完畢，前一個事件失敗不影響這個事件
+        await asyncio.wait([previous])
+
+    func = handler.find_handler(event)
+    if func is None:
+        logging.info("No handler of %s and no default handler", type(event).__name__)
+        return
+    await func(event)
+
+
+def dispatch(event):
+    """派送事件，同一位使用者的事件依序處理，不同使用者的事件同時處理"""
+    key = event_key(event)
+    task = asyncio.ensure_future(_dispatch(event, _user_tails.get(key)))
+    _user_tails[key] = task
+
+    def forget(_):
+        if _user_tails.get(key) is task:
+            del _user_tails[key]
+
+    task.add_done_callback(forget)
+    return task
+
+
+async def callback(request):
+    ip = request.remote
+    method = request.method
+    path = request.path
+
+    signature = request.headers.get("X-Line-Signature", "")
+    if not signature:
+        extra = {"ip": ip, "method": method, "path": path, "status": 400, "size": 0}
+        logging.warning("Missing X-Line-Signature header", extra=extra)
+        return web.Response(status=400, text="Bad Request")
+
+    body = await request.text()
+
+    try:
+        payload = handler.parser.parse(body, signature, as_payload=True)
+        tasks = [dispatch(event) for event in payload.events]
+        if tasks:
+            # asyncio.wait 不會在請求被取消時一併取消事件的處理
+            await asyncio.wait(tasks)
+        # 所有事件處理完畢後，再拋出第一個錯誤
+        errors = [task.exception() for task in tasks if not task.cancelled()]
+        for error in errors:
+            if error is not None:
+                raise error
+
+        extra = {
+            "ip": ip,
+            "method": method,
+            "path": path,
+            "status": 200,
+            "size": len(body),
+        }
+        logging.info("Request processed successfully", extra=extra)
+        return web.Response(text="OK")
+
+    except InvalidSignatureError:
+        extra = {"ip": ip, "method": method, "path": path, "status": 400, "size": 0}
+        logging.warning("Invalid signature", extra=extra)
+        return web.Response(status=400, text="Bad Request")
+    except Exception as e:
+        extra = {"ip": ip, "method": method, "path": path, "status": 500, "size": 0}
+        logging.error("Error processing webhook: %s", str(e), extra=extra)
+        return web.Response(status=500, text="Server Error")
+
+
+async def on_startup(web_app):
+    bot.warm_caches()
+    # build_reply 在 state_lane 的執行緒中執行，資料庫讀寫改由 database 的執行緒執行
+    bot.use_database(BlockingDatabase(database, asyncio.get_running_loop()))
+
+
+async def on_cleanup(web_app):
+    """關閉 LINE 連線與執行緒，寫入佇列中的答題記錄並關閉資料庫"""
+    try:
+        await line_client.aclose()
+        await asyncio.to_thread(state_lane.shutdown)
+        await asyncio.to_thread(database.close)
+    finally:
+        bot.shutdown()
+
+
+async def create_app():
+    """aiohttp 應用程式（gunicorn 的 aiohttp.GunicornWebWorker 或 python async_app.py）"""
+    web_app = web.Application()
+    web_app.router.add_post("/", callback)
+    web_app.on_startup.append(on_startup)
+    web_app.on_cleanup.append(on_cleanup)
+    return web_app
+
+
+if __name__ == "__main__":
+    ssl_context = None
+    certfile = os.environ.get("SSL_CERT_FILE", "ssl/cert.pem")
+    if certfile and os.path.exists(certfile):
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(
+            certfile, os.environ.get("SSL_KEY_FILE", "ssl/key.pem")
+        )
+    web.run_app(
+        create_app(),
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", 8080)),
+        ssl_context=ssl_context,
+    )
@@ -0,0 +1,203 @@
+"""Database 的 asyncio 介面：在專用的執行緒池中執行阻塞的 SQLite 操作。"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DatabaseLane:
+    """一組執行資料庫操作的執行緒，限制同時排隊的操作數並記錄等待時間"""
+
+    def __init__(self, name, workers, max_pending):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name
+        )
+        # 超過上限的操作在 event loop 中等待，不會佔用執行緒
+        self._slots = asyncio.Semaphore(max_pending)
+        self._lock = threading.Lock()
+
+        # 監控數據
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _run(self, enqueued_at, fn, args, kwargs):
+        wait = time.monotonic() - enqueued_at
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    async def call(self, fn, *args, shield=False, **kwargs):
+        """在執行緒池中執行 fn；shield=True 時呼叫端被取消也會執行完畢"""
+        enqueued_at = time.monotonic()
+        with self._lock:
+            self.queued += 1
+            self.max_depth = max(self.max_depth, self.queued + self.running)
+
+        try:
+            await self._slots.acquire()
+        except asyncio.CancelledError:
+            with self._lock:
+                self.queued -= 1
+            raise
+
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(self._run, enqueued_at, fn, args, kwargs)
+        # asyncio.Semaphore 不是執行緒安全的，必須回到 event loop 中釋放
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._slots.release)
+        )
+        # 取消尚未開始的操作時，_run 不會執行，需要自行更新排隊數
+        future.add_done_callback(self._on_done)
+        wrapped = asyncio.wrap_future(future)
+        if shield:
+            return await asyncio.shield(wrapped)
+        return await wrapped
+
+    def _on_done(self, future):
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    def stats(self):
+        """排隊深度、執行中數量與平均等待時間"""
+        with self._lock:
+            started = self.completed + self.running
+            return {
+                "workers": self.workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "max_depth": self.max_depth,
+                "avg_wait_ms": self.total_wait / started * 1000 if started else 0,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class AsyncDatabase:
+    """Database 的非同步版本
+
+    寫入由單一執行緒依序執行，避免多個寫入者互相等待 SQLite 的寫入鎖；
+    讀取在另一組執行緒中平行執行（WAL 模式下讀取不會被寫入阻擋）。
+    排隊中的操作數超過 max_pending 時，新的操作會在 event loop 中等待。
+    一個 AsyncDatabase 只能在同一個 event loop 中使用。
+    """
+
+    def __init__(self, db, readers=4, max_pending=1000):
+        self.db = db
+        self.writer = DatabaseLane("db-writer", 1, max_pending)
+        self.readers = DatabaseLane("db-reader", readers, max_pending)
+
+    async def record_answer(self, *args, **kwargs):
+        # 答題記錄一旦送出就必須寫入，不隨呼叫端取消
+        return await self.writer.call(
+            self.db.record_answer, *args, shield=True, **kwargs
+        )
+
+    async def update_user_state(self, user_id, database_name):
+        return await self.writer.call(
+            self.db.update_user_state, user_id, database_name, shield=True
+        )
+
+    async def get_user_state(self, user_id):
+        return await self.readers.call(self.db.get_user_state, user_id)
+
+    async def get_wrong_questions(self, user_id, database_name=None, limit=10):
+        return await self.readers.call(
+            self.db.get_wrong_questions, user_id, database_name, limit
+        )
+
+    async def get_user_statistics(self, user_id, database_name):
+        return await self.readers.call(
+            self.db.get_user_statistics, user_id, database_name
+        )
+
+    async def get_question_attempt_stats(self, question_id, database_name):
+        return await self.readers.call(
+            self.db.get_question_attempt_stats, question_id, database_name
+        )
+
+    def stats(self):
+        """寫入與讀取執行緒的排隊深度與等待時間"""
+        return {"writer": self.writer.stats(), "readers": self.readers.stats()}
+
+    def close(self):
+        """等待已送出的操作完成後結束執行緒（不會關閉底層的 Database）"""
+        self.writer.shutdown()
+        self.readers.shutdown()
+
+
+class BlockingDatabase:
+    """在 event loop 以外的執行緒中同步使用 AsyncDatabase
+
+    同步的程式碼（例如在執行緒中產生回覆的 build_reply）可以把它當作 Database 使用，
+    讀寫仍由 AsyncDatabase 的寫入與讀取執行緒執行，並計入它們的監控數據；
+    其他屬性與方法（close、wait_for_writes 等）直接使用原本的 Database。
+    不能在 loop 的執行緒中呼叫（會拋出 RuntimeError）。
+    """
+
+    def __init__(self, database, loop):
+        self.database = database
+        self.loop = loop
+
+    def _wait(self, coroutine):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            coroutine.close()
+            raise RuntimeError(
+                "BlockingDatabase called from its event loop; await AsyncDatabase instead"
+            )
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def record_answer(self, *args, **kwargs):
+        return self._wait(self.database.record_answer(*args, **kwargs))
+
+    def update_user_state(self, user_id, database_name):
+        return self._wait(self.database.update_user_state(user_id, database_name))
+
+    def get_user_state(self, user_id):
+        return self._wait(self.database.get_user_state(user_id))
+
+    def get_wrong_questions(self, user_id, database_name=None, limit=10):
+        return self._wait(
+            self.database.get_wrong_questions(user_id, database_name, limit)
+        )
+
+    def get_user_statistics(self, user_id, database_name):
+        return self._wait(self.database.get_user_statistics(user_id, database_name))
+
+    def get_question_attempt_stats(self, question_id, database_name):
+        return self._wait(
+            self.database.get_question_attempt_stats(question_id, database_name)
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.database.db, name)
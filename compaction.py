@@ -0,0 +1,173 @@
+"""答題記錄的保存期限與壓縮
+
+超過保存期限的答題記錄會合併成 answer_summaries 中每位使用者每題一筆的摘要，
+接著刪除原始記錄與不再被參照的題目內容，最後釋放資料庫檔案的空間。
+統計（user_bank_stats、question_stats）與錯題（wrong_questions）本身就是累計資料，
+壓縮不會改變 get_user_statistics、get_question_attempt_stats 與 get_wrong_questions 的結果；
+rebuild-stats 重新計算時也會把摘要算進去。
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只能以單一行程執行
+    fcntl = None
+
+
+def compact_database(
+    db, retention_days=180, batch_size=10000, vacuum="incremental", full_vacuum=True
+):
+    """壓縮單一資料庫檔案，回傳壓縮的記錄數、刪除的題目內容數與釋放的頁數
+
+    vacuum 為 "incremental"、"full" 或 "none"。第一次使用 incremental 時
+    需要執行一次完整的 VACUUM 才能切換成 auto_vacuum=INCREMENTAL。
+    full_vacuum=False 時不執行完整的 VACUUM（會鎖住整個資料庫並重寫檔案），
+    尚未切換 auto_vacuum 的資料庫只壓縮記錄，不釋放空間。
+    """
+    if db.write_queue is not None:
+        db.write_queue.flush()
+
+    cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat(" ")
+    conn = db.get_connection()
+
+    row = conn.execute(
+        "SELECT MIN(id), MAX(id) FROM answer_records WHERE answer_time < ?", (cutoff,)
+    ).fetchone()
+    compacted = 0
+    if row[0] is not None:
+        # 依 id 範圍分批處理，每批各自一個短交易，不會長時間擋住線上的寫入
+        for start in range(row[0], row[1] + 1, batch_size):
+            end = start + batch_size - 1
+            with conn:
+                conn.execute(
+                    """
+                    INSERT INTO answer_summaries
+                    (user_id, database_name, question_id, is_wrong_question_practice,
+                     attempts, correct_attempts, first_answer_time, last_answer_time)
+                    SELECT user_id, database_name, question_id,
+                           CASE WHEN is_wrong_question_practice = 1 THEN 1 ELSE 0 END,
+                           COUNT(*), SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END),
+                           MIN(answer_time), MAX(answer_time)
+                    FROM answer_records
+                    WHERE id BETWEEN ? AND ? AND answer_time < ?
+                    GROUP BY 1, 2, 3, 4
+                    ON CONFLICT(user_id, database_name, question_id,
+                                is_wrong_question_practice) DO UPDATE SET
+                        attempts = attempts + excluded.attempts,
+                        correct_attempts = correct_attempts + excluded.correct_attempts,
+                        first_answer_time = MIN(first_answer_time, excluded.first_answer_time),
+                        last_answer_time = MAX(last_answer_time, excluded.last_answer_time)
+                    """,
+                    (start, end, cutoff),
+                )
+                cursor = conn.execute(
+                    "DELETE FROM answer_records WHERE id BETWEEN ? AND ? AND answer_time < ?",
+                    (start, end, cutoff),
+                )
+                compacted += cursor.rowcount
+
+    # 刪除答題記錄與錯題都不再參照的題目內容
+    with conn:
+        cursor = conn.execute("""
+            DELETE FROM question_snapshots
+            WHERE snapshot_hash NOT IN (
+                SELECT snapshot_hash FROM answer_records WHERE snapshot_hash IS NOT NULL
+                UNION
+                SELECT snapshot_hash FROM wrong_questions WHERE snapshot_hash IS NOT NULL
+            )
+        """)
+        snapshots = cursor.rowcount
+
+    freed = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    if vacuum == "incremental" and incremental:
+        # incremental_vacuum 每讀取一列結果才釋放一頁，必須讀完所有結果
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
+    elif vacuum in ("incremental", "full") and full_vacuum:
+        if vacuum == "incremental":
+            # auto_vacuum 模式要在 VACUUM 重建檔案後才會生效
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        freed = 0
+
+    return {"compacted": compacted, "snapshots": snapshots, "freed_pages": freed}
+
+
+def compact(
+    db, retention_days=180, batch_size=10000, vacuum="incremental", full_vacuum=True
+):
+    """壓縮資料庫（分片資料庫會逐一壓縮每個分片），回傳合計的結果"""
+    total = {"compacted": 0, "snapshots": 0, "freed_pages": 0}
+    for shard in getattr(db, "shards", [db]):
+        result = compact_database(
+            shard, retention_days, batch_size, vacuum, full_vacuum
+        )
+        for key in total:
+            total[key] += result[key]
+    return total
+
+
+class CompactionScheduler:
+    """在背景執行緒中每隔 interval 秒執行一次 compact
+
+    排程不執行完整的 VACUUM，第一次切換成 auto_vacuum=INCREMENTAL 請執行 manage.py compact。
+    多個 worker 行程都啟動排程時，只有取得 lock_file 的行程會執行壓縮，
+    該行程結束後由其他行程在下一次排程時接手。
+    """
+
+    def __init__(self, db, interval, lock_file=None, **options):
+        self.db = db
+        self.interval = interval
+        self.lock_file = lock_file
+        self.options = dict(options, full_vacuum=False)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_fd = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="compaction", daemon=True
+        )
+        self._thread.start()
+
+    def _acquire(self):
+        """取得跨行程的排程鎖並持有到 stop()；其他行程持有時回傳 False"""
+        if self.lock_file is None or fcntl is None or self._lock_fd is not None:
+            return True
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self._acquire():
+                continue
+            started = time.monotonic()
+            try:
+                result = compact(self.db, **self.options)
+                print(
+                    f"Compacted answer records in {time.monotonic() - started:.1f}s: {result}"
+                )
+            except Exception as e:
+                print(f"Error compacting answer records: {e}")
+
+    def stop(self, timeout=30):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
@@ -1,61 +1,122 @@
+import os
 import sqlite3
+import threading
 from datetime import datetime
 import json
 
+from migrations import migrate, question_hash, rebuild_question_stats, rebuild_user_stats
+from question_bank import question_banks
+from write_behind import WriteBehindQueue
+
+
+class ConnectionManager:
+    """每個執行緒保留一個長期使用的 SQLite 連線
+
+    連線使用 WAL 模式，讀取不會阻擋寫入；並設定 synchronous=NORMAL、
+    busy timeout 與 page cache 大小。fork 之後子行程會重新建立連線。
+    """
+
+    def __init__(self, db_file, busy_timeout=5000, cache_size=-16000):
+        self.db_file = db_file
+        self.busy_timeout = busy_timeout  # 毫秒
+        self.cache_size = cache_size  # 負數代表 KiB
+        self._local = threading.local()
+        self._connections = {}  # thread ident: connection
+        self._inherited = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """取得目前執行緒的連線"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._pid == os.getpid():
+            return conn
+
+        with self._lock:
+            self._after_fork()
+            self._prune()
+            conn = self._connect()
+            old = self._connections.get(threading.get_ident())
+            if old is not None:
+                old.close()
+            self._connections[threading.get_ident()] = conn
+        self._local.conn = conn
+        return conn
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        return conn
+
+    def _after_fork(self):
+        """fork 後從父行程繼承的連線不能在子行程中使用或關閉，只保留參照"""
+        if self._pid != os.getpid():
+            self._inherited.extend(self._connections.values())
+            self._connections = {}
+            self._local = threading.local()
+            self._pid = os.getpid()
+
+    def _prune(self):
+        """關閉已結束執行緒留下的連線"""
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in list(self._connections):
+            if ident not in alive:
+                self._connections.pop(ident).close()
+
+    def close_all(self):
+        """關閉所有執行緒的連線"""
+        with self._lock:
+            self._after_fork()
+            connections, self._connections = self._connections, {}
+            self._local = threading.local()
+        for conn in connections.values():
+            conn.close()
+
 
 class Database:
-    def __init__(self, db_file="user_records.db"):
+    def __init__(self, db_file="user_records.db", busy_timeout=5000, cache_size=-16000,
+                 write_behind=False, flush_interval=0.05, flush_batch=500):
         self.db_file = db_file
+        self.connections = ConnectionManager(db_file, busy_timeout, cache_size)
         self.init_db()
 
-    def get_connection(self):
-        return sqlite3.connect(self.db_file)
+        # 批次寫入模式：答題記錄先放進佇列，由背景執行緒合併成較少的交易寫入
+        self.write_queue = None
+        if write_behind:
+            self.write_queue = WriteBehindQueue(
+                self._write_answers, flush_interval=flush_interval, max_batch=flush_batch)
 
-    def init_db(self):
-        """初始化數據庫表結構"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+    def get_connection(self):
+        """取得目前執行緒的長期連線（搭配 with 使用時會自動 commit 或 rollback）"""
+        return self.connections.get()
 
-            # 用戶當前狀態表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_states (
-                    user_id TEXT PRIMARY KEY,
-                    current_database TEXT,
-                    last_active TIMESTAMP
-                )
-            ''')
-
-            # 答題記錄表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS answer_records (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT,
-                    question_id INTEGER,
-                    database_name TEXT,
-                    user_answer TEXT,
-                    correct_answer TEXT,
-                    is_correct BOOLEAN,
-                    answer_time TIMESTAMP,
-                    question_data TEXT,
-                    is_wrong_question_practice BOOLEAN DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES user_states(user_id)
-                )
-            ''')
-
-            # 錯題統計表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS wrong_questions (
-                    user_id TEXT,
-                    question_id INTEGER,
-                    database_name TEXT,
-                    wrong_count INTEGER DEFAULT 1,
-                    last_wrong_time TIMESTAMP,
-                    PRIMARY KEY (user_id, question_id, database_name),
-                    FOREIGN KEY (user_id) REFERENCES user_states(user_id)
-                )
-            ''')
+    def close(self):
+        """寫入佇列中的答題記錄並關閉所有資料庫連線"""
+        try:
+            if self.write_queue is not None:
+                self.write_queue.close()
+            # 把 WAL 的內容寫回資料庫檔案
+            self.get_connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            self.connections.close_all()
+
+    def wait_for_writes(self, user_id):
+        """等待使用者尚未寫入的答題記錄，讓之後的讀取包含這些記錄"""
+        if self.write_queue is not None:
+            self.write_queue.wait_user(user_id)
 
-            conn.commit()
+    def init_db(self):
+        """初始化數據庫表結構，並把舊的資料庫升級到最新版本"""
+        applied = migrate(self.get_connection())
+        if applied:
+            print(f"Database migrated to version {applied[-1]}")
 
     def update_user_state(self, user_id, database_name):
         """更新用戶當前使用的題庫"""
@@ -81,51 +142,130 @@ class Database:
 
     def record_answer(self, user_id, question_data, user_answer, is_correct, database_name, is_wrong_question_practice=False):
         """記錄用戶答題"""
+        row = (
+            user_id,
+            question_data['id'],
+            database_name,
+            user_answer,
+            question_data['answer'],
+            is_correct,
+            datetime.now(),
+            json.dumps(question_data),
+            is_wrong_question_practice
+        )
+
+        if self.write_queue is not None:
+            self.write_queue.put(user_id, row)
+        else:
+            self._write_answers([row])
+
+    def _write_answers(self, rows):
+        """在同一個交易中寫入多筆答題記錄"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
 
+            # 題目內容以雜湊去除重複，每種內容只儲存一次
+            snapshots = {question_hash(row[7]): row[7] for row in rows}
+            cursor.executemany('''
+                INSERT OR IGNORE INTO question_snapshots (snapshot_hash, question_data)
+                VALUES (?, ?)
+            ''', snapshots.items())
+            rows = [row[:7] + (question_hash(row[7]),) + row[8:] for row in rows]
+
             # 記錄答題歷史
-            cursor.execute('''
+            cursor.executemany('''
                 INSERT INTO answer_records 
                 (user_id, question_id, database_name, user_answer, correct_answer, 
-                is_correct, answer_time, question_data, is_wrong_question_practice)
+                is_correct, answer_time, snapshot_hash, is_wrong_question_practice)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id,
-                question_data['id'],
-                database_name,
-                user_answer,
-                question_data['answer'],
-                is_correct,
-                datetime.now(),
-                json.dumps(question_data),
-                is_wrong_question_practice
-            ))
-
-            # 如果答錯了，更新錯題統計
-            if not is_correct:
+            ''', rows)
+
+            for row in rows:
+                user_id, question_id, database_name = row[0], row[1], row[2]
+                is_correct, practice = row[5], 1 if row[8] else 0
+
+                # 如果答錯了，更新錯題統計
+                if not is_correct:
+                    cursor.execute('''
+                        UPDATE wrong_questions SET
+                            wrong_count = wrong_count + 1,
+                            last_wrong_time = ?,
+                            snapshot_hash = ?
+                        WHERE user_id = ? AND question_id = ? AND database_name = ?
+                    ''', (row[6], row[7], user_id, question_id, database_name))
+                    if cursor.rowcount == 0:
+                        cursor.execute('''
+                            INSERT INTO wrong_questions (user_id, question_id, database_name, wrong_count, last_wrong_time, snapshot_hash)
+                            VALUES (?, ?, ?, 1, ?, ?)
+                        ''', (user_id, question_id, database_name, row[6], row[7]))
+                        self._bump_user_stats(cursor, user_id, database_name, 'wrong_questions')
+
+                # 第一次作答或第一次答對這一題時更新使用者統計
                 cursor.execute('''
-                    INSERT INTO wrong_questions (user_id, question_id, database_name, wrong_count, last_wrong_time)
-                    VALUES (?, ?, ?, 1, ?)
-                    ON CONFLICT(user_id, question_id, database_name) DO UPDATE SET
-                        wrong_count = wrong_count + 1,
-                        last_wrong_time = excluded.last_wrong_time
-                ''', (user_id, question_data['id'], database_name, datetime.now()))
+                    INSERT OR IGNORE INTO user_question_progress
+                    (user_id, database_name, question_id, is_wrong_question_practice, is_correct)
+                    VALUES (?, ?, ?, ?, 0)
+                ''', (user_id, database_name, question_id, practice))
+                if cursor.rowcount == 1:
+                    self._bump_user_stats(cursor, user_id, database_name,
+                                          'practice_questions' if practice else 'answered_questions')
+                if is_correct:
+                    cursor.execute('''
+                        UPDATE user_question_progress SET is_correct = 1
+                        WHERE user_id = ? AND database_name = ? AND question_id = ?
+                        AND is_wrong_question_practice = ? AND is_correct = 0
+                    ''', (user_id, database_name, question_id, practice))
+                    if cursor.rowcount == 1:
+                        self._bump_user_stats(cursor, user_id, database_name,
+                                              'practice_correct' if practice else 'correct_questions')
+
+            # 更新每題的作答次數（錯題練習不計入）
+            attempts = {}
+            for row in rows:
+                if not row[8]:
+                    counts = attempts.setdefault((row[2], row[1]), [0, 0])
+                    counts[0] += 1
+                    counts[1] += 1 if row[5] else 0
+            cursor.executemany('''
+                INSERT INTO question_stats (database_name, question_id, total_attempts, correct_attempts)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(database_name, question_id) DO UPDATE SET
+                    total_attempts = total_attempts + excluded.total_attempts,
+                    correct_attempts = correct_attempts + excluded.correct_attempts
+            ''', [(key[0], key[1], total, correct) for key, (total, correct) in attempts.items()])
+
+            conn.commit()
 
+    @staticmethod
+    def _bump_user_stats(cursor, user_id, database_name, column):
+        cursor.execute(f'''
+            INSERT INTO user_bank_stats (user_id, database_name, {column})
+            VALUES (?, ?, 1)
+            ON CONFLICT(user_id, database_name) DO UPDATE SET
+                {column} = {column} + 1
+        ''', (user_id, database_name))
+
+    def rebuild_stats(self):
+        """由 answer_records 重新計算統計表"""
+        if self.write_queue is not None:
+            self.write_queue.flush()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            rebuild_question_stats(cursor)
+            rebuild_user_stats(cursor)
             conn.commit()
 
     def get_wrong_questions(self, user_id, database_name=None, limit=10):
         """獲取用戶的錯題列表"""
+        self.wait_for_writes(user_id)
         with self.get_connection() as conn:
             cursor = conn.cursor()
 
+            # 題目內容為最後一次答錯時的版本
             query = '''
-                SELECT w.question_id, w.database_name, w.wrong_count, 
-                       MAX(a.question_data) as question_data
+                SELECT w.question_id, w.database_name, w.wrong_count, s.question_data
                 FROM wrong_questions w
-                JOIN answer_records a ON w.question_id = a.question_id 
-                    AND w.user_id = a.user_id 
-                    AND w.database_name = a.database_name
+                JOIN question_snapshots s ON s.snapshot_hash = w.snapshot_hash
                 WHERE w.user_id = ?
             '''
             params = [user_id]
@@ -135,7 +275,6 @@ class Database:
                 params.append(database_name)
 
             query += '''
-                GROUP BY w.question_id, w.database_name
                 ORDER BY w.wrong_count DESC, w.last_wrong_time DESC
                 LIMIT ?
             '''
@@ -159,57 +298,35 @@ class Database:
     def get_total_questions(self, database_name):
         """獲取指定題庫的總題目數"""
         try:
-            with open(f'database/{database_name}.json', 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return len(data.get('questions', []))
+            return question_banks.count(database_name)
         except Exception as e:
             print(f"Error getting total questions: {e}")
             return 0
 
     def get_user_statistics(self, user_id, database_name):
         """獲取用戶的答題統計"""
+        self.wait_for_writes(user_id)
         with self.get_connection() as conn:
             cursor = conn.cursor()
 
-            # 修改查詢，使用DISTINCT計算不重複的題目數
-            query = '''
-                SELECT 
-                    COUNT(DISTINCT question_id) as total_answers,
-                    COUNT(DISTINCT CASE WHEN is_correct = 1 THEN question_id END) as correct_answers,
-                    (SELECT COUNT(DISTINCT question_id) FROM wrong_questions 
-                     WHERE user_id = ? AND database_name = ?) as total_wrong_questions
-                FROM answer_records
-                WHERE user_id = ? 
-                AND database_name = ?
-                AND is_wrong_question_practice = 0
-            '''
-
-            cursor.execute(
-                query, (user_id, database_name, user_id, database_name))
-            result = cursor.fetchone()
+            # 不重複的題目數由 user_bank_stats 在每次作答時累計
+            cursor.execute('''
+                SELECT answered_questions, correct_questions, wrong_questions,
+                       practice_questions, practice_correct
+                FROM user_bank_stats
+                WHERE user_id = ? AND database_name = ?
+            ''', (user_id, database_name))
+            result = cursor.fetchone() or (0, 0, 0, 0, 0)
 
-            total_answers = result[0] or 0  # 避免 None 值
-            correct_answers = result[1] or 0
-            total_wrong_questions = result[2] or 0
+            total_answers = result[0]
+            correct_answers = result[1]
+            total_wrong_questions = result[2]
+            practice_count = result[3]
+            practice_correct = result[4]
 
             # 獲取題庫總題目數
             total_questions = self.get_total_questions(database_name)
 
-            # 獲取錯題練習的統計
-            cursor.execute('''
-                SELECT 
-                    COUNT(DISTINCT question_id) as practice_count,
-                    COUNT(DISTINCT CASE WHEN is_correct = 1 THEN question_id END) as practice_correct
-                FROM answer_records
-                WHERE user_id = ? 
-                AND database_name = ?
-                AND is_wrong_question_practice = 1
-            ''', (user_id, database_name))
-
-            practice_result = cursor.fetchone()
-            practice_count = practice_result[0] or 0
-            practice_correct = practice_result[1] or 0
-
             return {
                 'total_answers': total_answers,
                 'correct_answers': correct_answers,
@@ -229,22 +346,26 @@ class Database:
                 cursor = conn.cursor()
 
                 # 查询题目的作答次数和答对次数
-                query = '''
-                    SELECT 
-                        COUNT(*) as total_attempts,
-                        SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) as correct_attempts
-                    FROM answer_records
-                    WHERE question_id = ? 
-                    AND database_name = ?
-                    AND is_wrong_question_practice = 0
-                '''
-
-                cursor.execute(query, (question_id, database_name))
-                result = cursor.fetchone()
+                cursor.execute('''
+                    SELECT total_attempts, correct_attempts
+                    FROM question_stats
+                    WHERE database_name = ? AND question_id = ?
+                ''', (database_name, question_id))
+                result = cursor.fetchone() or (0, 0)
+
+                total_attempts = result[0] or 0  # 避免 None 值
+                correct_attempts = result[1] or 0
+
+                # 加上還在寫入佇列中的記錄
+                if self.write_queue is not None:
+                    for row in self.write_queue.pending_rows():
+                        if row[1] == question_id and row[2] == database_name and not row[8]:
+                            total_attempts += 1
+                            correct_attempts += 1 if row[5] else 0
 
                 return {
-                    'total_attempts': result[0] or 0,  # 避免 None 值
-                    'correct_attempts': result[1] or 0
+                    'total_attempts': total_attempts,
+                    'correct_attempts': correct_attempts
                 }
         except Exception as e:
             print(f"Error getting question attempt stats: {e}")
@@ -0,0 +1,95 @@
+"""Flex Message 模板快取：模板只解析一次，每次請求只複製會被修改的路徑。"""
+
+import json
+import os
+import threading
+
+TEMPLATE_DIR = "templates"
+
+
+def _shallow_copy(node):
+    return dict(node) if isinstance(node, dict) else list(node)
+
+
+def _copy_path(node, path, copied):
+    if not path:
+        return
+
+    key, rest = path[0], path[1:]
+    if key == "*":
+        keys = list(node.keys()) if isinstance(node, dict) else range(len(node))
+    else:
+        keys = (key,)
+
+    for k in keys:
+        try:
+            child = node[k]
+        except (KeyError, IndexError, TypeError):
+            # 模板中不存在的路徑不會被修改，不需要複製
+            continue
+        if not isinstance(child, (dict, list)):
+            continue
+        if id(child) not in copied:
+            child = _shallow_copy(child)
+            node[k] = child
+            copied.add(id(child))
+        _copy_path(child, rest, copied)
+
+
+def copy_paths(template, paths=()):
+    """只複製指定路徑上的容器，其餘子樹與模板共用
+
+    Args:
+        template: 已解析的模板（不可被修改）
+        paths: 需要修改的路徑列表，例如 ("body", "contents", 1)；
+            "*" 代表該層的所有元素。路徑上每一層的 dict/list 都會被淺複製，
+            因此可以安全地修改或替換路徑終點的欄位。
+    """
+    root = _shallow_copy(template)
+    copied = {id(root)}
+    for path in paths:
+        _copy_path(root, path, copied)
+    return root
+
+
+class FlexTemplateCache:
+    """已解析 Flex 模板的快取
+
+    auto_reload 為 True 時，每次取用都會檢查檔案的 mtime 與大小，
+    模板在磁碟上變動後會自動重新載入。
+    """
+
+    def __init__(self, directory=TEMPLATE_DIR, auto_reload=False):
+        self.directory = directory
+        self.auto_reload = auto_reload
+        self._templates = {}  # file_name: (signature, template)
+        self._lock = threading.Lock()
+
+    def _signature(self, path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self, file_name):
+        """取得已解析的模板本體，呼叫端不可修改回傳值"""
+        cached = self._templates.get(file_name)
+        if cached is not None and not self.auto_reload:
+            return cached[1]
+
+        path = os.path.join(self.directory, file_name)
+        signature = self._signature(path) if self.auto_reload else None
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        with self._lock:
+            with open(path, "r", encoding="utf-8") as f:
+                template = json.load(f)
+            self._templates[file_name] = (signature, template)
+        return template
+
+    def get(self, file_name, paths=()):
+        """取得可修改的模板副本，只有 paths 上的容器會被複製"""
+        return copy_paths(self.load(file_name), paths)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
@@ -0,0 +1,63 @@
+"""正式環境的 gunicorn 設定：gunicorn -c gunicorn.conf.py
+
+每個 worker 行程各自 import app（不使用 preload_app），資料庫連線、背景執行緒與
+LINE 用戶端都屬於自己的行程；worker 結束時由 worker_exit 寫入剩下的答題記錄並關閉連線。
+"""
+
+import multiprocessing
+import os
+import sys
+
+from dotenv import find_dotenv, load_dotenv
+
+load_dotenv(find_dotenv())
+
+wsgi_app = "app:create_app()"
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 8080)}"
+
+# 每個 worker 是一個行程，行程內以多個執行緒處理請求（等待 LINE API 時不會佔住整個行程）
+# memory 模式的答題狀態只存在單一行程中，只有 SESSION_BACKEND=sqlite 時才預設使用多個 worker
+session_backend = os.environ.get("SESSION_BACKEND", "memory")
+default_workers = 1
+if session_backend == "sqlite":
+    default_workers = min(multiprocessing.cpu_count() * 2 + 1, 8)
+workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
+if workers > 1 and session_backend == "memory":
+    raise RuntimeError(
+        f"WEB_CONCURRENCY={workers} requires SESSION_BACKEND=sqlite; "
+        "memory sessions are not shared between workers"
+    )
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# ASYNC_WEBHOOK=true 時改用 aiohttp 的 asyncio 處理路徑（async_app.py），每個 worker 只有一個 event loop
+if os.environ.get("ASYNC_WEBHOOK", "false").lower() == "true":
+    wsgi_app = "async_app:create_app"
+    worker_class = "aiohttp.GunicornWebWorker"
+
+# 與 LINE 平台之間保持連線，以及處理逾時、關閉時等待請求完成的秒數
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+
+# 尚未被 accept 的連線上限；worker 處理此數量的請求後自動重新啟動（0 代表不重新啟動）
+backlog = int(os.environ.get("GUNICORN_BACKLOG", 2048))
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+# 保留原本開發伺服器使用的憑證；放在 Nginx 等反向代理後面時設定 SSL_CERT_FILE= 關閉 TLS
+certfile = os.environ.get("SSL_CERT_FILE", "ssl/cert.pem")
+keyfile = os.environ.get("SSL_KEY_FILE", "ssl/key.pem")
+if not certfile or not os.path.exists(certfile):
+    certfile = keyfile = None
+
+accesslog = None  # 存取記錄由 app 的 after_request 寫入 LOG_DIR
+errorlog = "-"
+
+
+def worker_exit(server, worker):
+    """worker 結束（重新啟動或關閉）時寫入佇列中的答題記錄並關閉連線"""
+    app = sys.modules.get("app")
+    if app is not None:
+        app.shutdown()
@@ -0,0 +1,196 @@
+"""LINE Messaging API 用戶端：行程內共用的背景 event loop 與連線池。"""
+
+import asyncio
+import copy
+import os
+import threading
+
+from linebot.v3.messaging import (
+    ApiClient,
+    AsyncApiClient,
+    AsyncMessagingApi,
+    MessagingApi,
+    ShowLoadingAnimationRequest,
+)
+
+
+def _with_pool_size(configuration, pool_size):
+    if pool_size is None:
+        return configuration
+    configuration = copy.copy(configuration)
+    configuration.connection_pool_maxsize = pool_size
+    return configuration
+
+
+class LineClient:
+    """行程內共用、執行緒安全的同步 MessagingApi
+
+    所有回覆共用同一個 ApiClient 及其 urllib3 連線池，連線保持 keep-alive，
+    不必每則訊息都重新建立 TLS 連線。fork 之後會在子行程中重新建立連線池。
+    """
+
+    def __init__(self, configuration, pool_size=None):
+        self.configuration = _with_pool_size(configuration, pool_size)
+        self._api_client = None
+        self._messaging_api = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def messaging_api(self):
+        messaging_api = self._messaging_api
+        if messaging_api is not None and self._pid == os.getpid():
+            return messaging_api
+
+        with self._lock:
+            if self._messaging_api is None or self._pid != os.getpid():
+                self._api_client = ApiClient(self.configuration)
+                self._messaging_api = MessagingApi(self._api_client)
+                self._pid = os.getpid()
+            return self._messaging_api
+
+    def close(self):
+        """關閉連線池中的所有連線"""
+        with self._lock:
+            if self._api_client is not None:
+                self._api_client.rest_client.pool_manager.clear()
+                self._api_client.close()
+                self._api_client = None
+                self._messaging_api = None
+
+
+class BackgroundEventLoop:
+    """在背景 daemon 執行緒中持續運行的 asyncio event loop
+
+    同步的 webhook 處理程式透過 submit() 把 coroutine 交給這個 loop 執行，
+    不需要每則訊息都建立並關閉一個新的 event loop。
+    """
+
+    def __init__(self, name="line-event-loop"):
+        self.name = name
+        self.loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self.loop
+
+            ready = threading.Event()
+
+            def run():
+                self.loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self.loop)
+                ready.set()
+                self.loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+            self._thread.start()
+            ready.wait()
+            return self.loop
+
+    def submit(self, coro):
+        """把 coroutine 交給背景 loop 執行，回傳 concurrent.futures.Future"""
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    def stop(self, timeout=5):
+        with self._lock:
+            if self._thread is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
+
+
+class LoadingAnimation:
+    """已排程的載入動畫"""
+
+    __slots__ = ("future",)
+
+    def __init__(self, future):
+        self.future = future
+
+    def cancel(self):
+        """回覆已準備好，尚未送出的載入動畫不再送出"""
+        if self.future is not None:
+            self.future.cancel()
+
+
+class AsyncLineClient:
+    """在背景 event loop 上共用的 AsyncMessagingApi
+
+    AsyncApiClient 內部的 aiohttp session 必須在使用它的 loop 中建立，
+    因此在第一次使用時才於背景 loop 內建立，之後所有請求共用同一個連線池。
+    event_loop 為 None 時直接在呼叫端正在執行的 loop 中使用（例如 aiohttp 的 webhook），
+    此時 start_loading_animation 必須在該 loop 中呼叫，並以 aclose() 關閉。
+    """
+
+    def __init__(self, configuration, event_loop=None, pool_size=None):
+        self.configuration = _with_pool_size(configuration, pool_size)
+        self.event_loop = event_loop
+        self._api_client = None
+        self._messaging_api = None
+
+    async def get_api(self):
+        """取得共用的 AsyncMessagingApi（只能在使用這個用戶端的 loop 中呼叫）"""
+        if self._messaging_api is None:
+            self._api_client = AsyncApiClient(self.configuration)
+            self._messaging_api = AsyncMessagingApi(self._api_client)
+        return self._messaging_api
+
+    async def _show_loading_animation(self, user_id, loading_seconds):
+        api = await self.get_api()
+        await api.show_loading_animation(
+            ShowLoadingAnimationRequest(chatId=user_id, loadingSeconds=loading_seconds)
+        )
+
+    def show_loading_animation(self, user_id, loading_seconds=5):
+        """送出載入動畫請求，回傳 concurrent.futures.Future"""
+        return self.event_loop.submit(
+            self._show_loading_animation(user_id, loading_seconds)
+        )
+
+    async def _send_loading_animation(self, user_id, loading_seconds):
+        try:
+            await self._show_loading_animation(user_id, loading_seconds)
+        except Exception as e:
+            print(f"Error showing loading animation: {e}")
+
+    async def _delayed_loading_animation(self, user_id, delay, loading_seconds):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # 請求一旦送出就不再取消，避免中斷共用連線池中的連線
+        await asyncio.shield(self._send_loading_animation(user_id, loading_seconds))
+
+    def start_loading_animation(self, user_id, delay=0.0, loading_seconds=5):
+        """在背景排程載入動畫，不會阻塞呼叫端
+
+        動畫在 delay 秒後才送出；回覆在這之前準備好並呼叫 cancel() 時，
+        就不會送出任何請求。送出失敗只會記錄錯誤，不會影響回覆。
+        """
+        coro = self._delayed_loading_animation(user_id, delay, loading_seconds)
+        try:
+            if self.event_loop is None:
+                future = asyncio.ensure_future(coro)
+            else:
+                future = self.event_loop.submit(coro)
+        except Exception as e:
+            coro.close()
+            print(f"Error scheduling loading animation: {e}")
+            future = None
+        return LoadingAnimation(future)
+
+    async def aclose(self):
+        """在使用這個用戶端的 loop 中關閉共用的 aiohttp session"""
+        if self._api_client is not None:
+            await self._api_client.close()
+            self._api_client = None
+            self._messaging_api = None
+
+    def close(self, timeout=5):
+        """關閉背景 loop 中共用的 aiohttp session"""
+        if self.event_loop is None or self.event_loop.loop is None:
+            return
+        self.event_loop.submit(self.aclose()).result(timeout)
@@ -0,0 +1,137 @@
+"""維護用指令列工具
+
+用法：
+    python manage.py compile-banks [題庫名稱 ...]
+    python manage.py rebuild-stats [--db user_records.db] [--shards N]
+    python manage.py reshard --shards N [--db user_records.db] 來源檔案 ...
+    python manage.py compact [--db user_records.db] [--retention-days 180]
+"""
+
+import argparse
+import os
+import sys
+
+from compaction import compact
+from database import Database
+from question_bank import DATABASE_DIR, compile_bank
+from sharded_database import ShardedDatabase, reshard
+
+
+def compile_banks(args):
+    """將 database/*.json 編譯成可隨機讀取的索引格式"""
+    names = args.names or sorted(
+        f[:-5] for f in os.listdir(args.directory) if f.endswith(".json")
+    )
+    for name in names:
+        json_path = os.path.join(args.directory, f"{name}.json")
+        count = compile_bank(json_path)
+        print(f"{name}: {count} questions compiled")
+    return 0
+
+
+def open_database(args):
+    if args.shards > 1:
+        return ShardedDatabase(args.db, args.shards)
+    return Database(args.db)
+
+
+def rebuild_stats(args):
+    """由答題記錄重新計算統計表（資料庫升級時會自動執行一次）"""
+    db = open_database(args)
+    try:
+        db.rebuild_stats()
+    finally:
+        db.close()
+    print(f"{args.db}: statistics rebuilt")
+    return 0
+
+
+def reshard_database(args):
+    """把既有的資料庫檔案依使用者重新分配到 N 個分片"""
+    try:
+        counts = reshard(args.sources, args.db, args.shards)
+    except FileExistsError as e:
+        print(f"Error resharding: {e}")
+        return 1
+    for index, (users, answers) in enumerate(counts):
+        print(f"shard {index}: {users} users, {answers} answer records")
+    return 0
+
+
+def compact_records(args):
+    """壓縮超過保存期限的答題記錄並釋放資料庫空間"""
+    db = open_database(args)
+    try:
+        result = compact(
+            db,
+            retention_days=args.retention_days,
+            batch_size=args.batch_size,
+            vacuum=args.vacuum,
+        )
+    finally:
+        db.close()
+    print(
+        f"{args.db}: {result['compacted']} answer records compacted, "
+        f"{result['snapshots']} question snapshots removed, "
+        f"{result['freed_pages']} pages freed"
+    )
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="exam-line-bot 維護工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compile_parser = subparsers.add_parser(
+        "compile-banks", help="將 JSON 題庫編譯成 mmap 索引格式"
+    )
+    compile_parser.add_argument("names", nargs="*", help="題庫名稱，預設為全部")
+    compile_parser.add_argument("--directory", default=DATABASE_DIR, help="題庫資料夾")
+    compile_parser.set_defaults(func=compile_banks)
+
+    stats_parser = subparsers.add_parser(
+        "rebuild-stats", help="由答題記錄重新計算統計表"
+    )
+    stats_parser.add_argument("--db", default="user_records.db", help="資料庫檔案")
+    stats_parser.add_argument("--shards", type=int, default=1, help="分片數")
+    stats_parser.set_defaults(func=rebuild_stats)
+
+    reshard_parser = subparsers.add_parser(
+        "reshard", help="把既有的資料庫依使用者重新分配到多個分片"
+    )
+    reshard_parser.add_argument("sources", nargs="+", help="來源資料庫檔案")
+    reshard_parser.add_argument("--shards", type=int, required=True, help="分片數")
+    reshard_parser.add_argument(
+        "--db", default="user_records.db", help="分片檔名，例如 user_records.0.db"
+    )
+    reshard_parser.set_defaults(func=reshard_database)
+
+    compact_parser = subparsers.add_parser(
+        "compact", help="把超過保存期限的答題記錄壓縮成摘要"
+    )
+    compact_parser.add_argument("--db", default="user_records.db", help="資料庫檔案")
+    compact_parser.add_argument("--shards", type=int, default=1, help="分片數")
+    compact_parser.add_argument(
+        "--retention-days", type=int, default=180, help="原始答題記錄保存天數"
+    )
+    compact_parser.add_argument(
+        "--batch-size", type=int, default=10000, help="每個交易處理的記錄數"
+    )
+    compact_parser.add_argument(
+        "--vacuum",
+        choices=("incremental", "full", "none"),
+        default="incremental",
+        help="壓縮後釋放空間的方式",
+    )
+    compact_parser.set_defaults(func=compact_records)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""資料庫結構版本遷移
+
+資料庫目前的版本記錄在 PRAGMA user_version。每個遷移只會執行一次，
+依版本號依序套用，已存在的 user_records.db 也會就地升級。
+新增遷移時在 MIGRATIONS 最後加上下一個版本號，不要修改已發佈的遷移。
+"""
+
+
+import hashlib
+
+
+def question_hash(question_json):
+    """題目內容（包含打亂後的選項順序）的雜湊，作為 question_snapshots 的主鍵"""
+    return hashlib.blake2b(question_json.encode('utf-8'), digest_size=16).digest()
+
+
+def create_base_tables(cursor):
+    """版本 1：原本的資料表（舊資料庫已經存在，IF NOT EXISTS 會略過）"""
+    # 用戶當前狀態表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id TEXT PRIMARY KEY,
+            current_database TEXT,
+            last_active TIMESTAMP
+        )
+    ''')
+
+    # 答題記錄表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS answer_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            question_id INTEGER,
+            database_name TEXT,
+            user_answer TEXT,
+            correct_answer TEXT,
+            is_correct BOOLEAN,
+            answer_time TIMESTAMP,
+            question_data TEXT,
+            is_wrong_question_practice BOOLEAN DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES user_states(user_id)
+        )
+    ''')
+
+    # 錯題統計表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS wrong_questions (
+            user_id TEXT,
+            question_id INTEGER,
+            database_name TEXT,
+            wrong_count INTEGER DEFAULT 1,
+            last_wrong_time TIMESTAMP,
+            PRIMARY KEY (user_id, question_id, database_name),
+            FOREIGN KEY (user_id) REFERENCES user_states(user_id)
+        )
+    ''')
+
+
+def add_answer_record_indexes(cursor):
+    """版本 2：answer_records 常用查詢的覆蓋索引"""
+    # get_user_statistics：依使用者、題庫與是否為錯題練習計算不重複題數
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_answer_records_user
+        ON answer_records (user_id, database_name, is_wrong_question_practice,
+                           question_id, is_correct)
+    ''')
+
+    # get_question_attempt_stats：單一題目的作答次數與答對次數
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_answer_records_question
+        ON answer_records (question_id, database_name, is_wrong_question_practice,
+                           is_correct)
+    ''')
+
+    cursor.execute('ANALYZE')
+
+
+def rebuild_question_stats(cursor, include_summaries=True):
+    """由 answer_records 與壓縮後的 answer_summaries 重新計算每題的作答次數（不含錯題練習）
+
+    include_summaries 只在 answer_summaries 資料表建立之前的遷移中設為 False。
+    """
+    summaries = '''
+        UNION ALL
+        SELECT database_name, question_id, SUM(attempts), SUM(correct_attempts)
+        FROM answer_summaries
+        WHERE is_wrong_question_practice = 0
+        GROUP BY database_name, question_id
+    ''' if include_summaries else ''
+
+    cursor.execute('DELETE FROM question_stats')
+    cursor.execute(f'''
+        INSERT INTO question_stats (database_name, question_id, total_attempts, correct_attempts)
+        SELECT database_name, question_id, SUM(total_attempts), SUM(correct_attempts)
+        FROM (
+            SELECT database_name, question_id, COUNT(*) AS total_attempts,
+                   SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) AS correct_attempts
+            FROM answer_records
+            WHERE is_wrong_question_practice = 0
+            GROUP BY database_name, question_id
+            {summaries}
+        )
+        GROUP BY database_name, question_id
+    ''')
+
+
+def add_question_stats(cursor):
+    """版本 3：每題作答次數的累計表，顯示題目時只需要一次主鍵查詢"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS question_stats (
+            database_name TEXT,
+            question_id INTEGER,
+            total_attempts INTEGER NOT NULL DEFAULT 0,
+            correct_attempts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (database_name, question_id)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_question_stats(cursor, include_summaries=False)
+
+
+def rebuild_user_stats(cursor, include_summaries=True):
+    """由答題記錄與 wrong_questions 重新計算每位使用者在各題庫的統計"""
+    summaries = '''
+        UNION ALL
+        SELECT user_id, database_name, question_id, is_wrong_question_practice,
+               correct_attempts > 0
+        FROM answer_summaries
+    ''' if include_summaries else ''
+
+    cursor.execute('DELETE FROM user_question_progress')
+    cursor.execute(f'''
+        INSERT INTO user_question_progress
+        (user_id, database_name, question_id, is_wrong_question_practice, is_correct)
+        SELECT user_id, database_name, question_id, is_wrong_question_practice, MAX(is_correct)
+        FROM (
+            SELECT user_id, database_name, question_id,
+                   CASE WHEN is_wrong_question_practice = 1 THEN 1 ELSE 0 END
+                       AS is_wrong_question_practice,
+                   CASE WHEN is_correct = 1 THEN 1 ELSE 0 END AS is_correct
+            FROM answer_records
+            {summaries}
+        )
+        GROUP BY 1, 2, 3, 4
+    ''')
+
+    cursor.execute('DELETE FROM user_bank_stats')
+    cursor.execute('''
+        INSERT INTO user_bank_stats
+        (user_id, database_name, answered_questions, correct_questions,
+         practice_questions, practice_correct)
+        SELECT user_id, database_name,
+               SUM(is_wrong_question_practice = 0),
+               SUM(is_wrong_question_practice = 0 AND is_correct = 1),
+               SUM(is_wrong_question_practice = 1),
+               SUM(is_wrong_question_practice = 1 AND is_correct = 1)
+        FROM user_question_progress
+        GROUP BY user_id, database_name
+    ''')
+    cursor.execute('''
+        INSERT INTO user_bank_stats (user_id, database_name, wrong_questions)
+        SELECT user_id, database_name, COUNT(*)
+        FROM wrong_questions
+        WHERE true
+        GROUP BY user_id, database_name
+        ON CONFLICT(user_id, database_name) DO UPDATE SET
+            wrong_questions = excluded.wrong_questions
+    ''')
+
+
+def add_user_stats(cursor):
+    """版本 4：每位使用者在各題庫的統計累計表，查看統計時不需要掃描答題記錄"""
+    # 使用者作答過的題目，用來判斷是否為第一次作答或第一次答對
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_question_progress (
+            user_id TEXT,
+            database_name TEXT,
+            question_id INTEGER,
+            is_wrong_question_practice INTEGER,
+            is_correct INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, database_name, question_id, is_wrong_question_practice)
+        ) WITHOUT ROWID
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_bank_stats (
+            user_id TEXT,
+            database_name TEXT,
+            answered_questions INTEGER NOT NULL DEFAULT 0,
+            correct_questions INTEGER NOT NULL DEFAULT 0,
+            wrong_questions INTEGER NOT NULL DEFAULT 0,
+            practice_questions INTEGER NOT NULL DEFAULT 0,
+            practice_correct INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, database_name)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_user_stats(cursor, include_summaries=False)
+
+
+def add_question_snapshots(cursor):
+    """版本 5：題目內容只儲存一份，答題記錄與錯題改為參照內容的雜湊"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS question_snapshots (
+            snapshot_hash BLOB PRIMARY KEY,
+            question_data TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('ALTER TABLE answer_records ADD COLUMN snapshot_hash BLOB')
+    cursor.execute('ALTER TABLE wrong_questions ADD COLUMN snapshot_hash BLOB')
+
+    cursor.connection.create_function('question_hash', 1, question_hash, deterministic=True)
+
+    # 既有的題目內容去除重複後搬到 question_snapshots
+    cursor.execute('''
+        INSERT OR IGNORE INTO question_snapshots (snapshot_hash, question_data)
+        SELECT question_hash(question_data), question_data
+        FROM (SELECT DISTINCT question_data FROM answer_records
+              WHERE question_data IS NOT NULL)
+    ''')
+
+    # 錯題沿用原本 get_wrong_questions 取得的題目內容
+    cursor.execute('''
+        UPDATE wrong_questions SET snapshot_hash = (
+            SELECT question_hash(MAX(a.question_data))
+            FROM answer_records a
+            WHERE a.user_id = wrong_questions.user_id
+            AND a.database_name = wrong_questions.database_name
+            AND a.question_id = wrong_questions.question_id
+            AND a.question_data IS NOT NULL
+        )
+    ''')
+
+    cursor.execute('''
+        UPDATE answer_records
+        SET snapshot_hash = question_hash(question_data), question_data = NULL
+        WHERE question_data IS NOT NULL
+    ''')
+
+
+def add_answer_summaries(cursor):
+    """版本 6：超過保存期限的答題記錄壓縮成每位使用者每題一筆的摘要"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS answer_summaries (
+            user_id TEXT,
+            database_name TEXT,
+            question_id INTEGER,
+            is_wrong_question_practice INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            correct_attempts INTEGER NOT NULL DEFAULT 0,
+            first_answer_time TIMESTAMP,
+            last_answer_time TIMESTAMP,
+            PRIMARY KEY (user_id, database_name, question_id, is_wrong_question_practice)
+        ) WITHOUT ROWID
+    ''')
+
+
+def drop_answer_record_indexes(cursor):
+    """版本 7：統計改由累計表查詢後，版本 2 的兩個索引不再被使用，只會拖慢寫入"""
+    cursor.execute('DROP INDEX IF EXISTS idx_answer_records_user')
+    cursor.execute('DROP INDEX IF EXISTS idx_answer_records_question')
+
+
+def add_answer_time_index(cursor):
+    """版本 8：壓縮時以 answer_time 找出超過保存期限的 id 範圍，不需要掃描整張表"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_answer_records_time
+        ON answer_records (answer_time)
+    ''')
+
+
+MIGRATIONS = [
+    (1, create_base_tables),
+    (2, add_answer_record_indexes),
+    (3, add_question_stats),
+    (4, add_user_stats),
+    (5, add_question_snapshots),
+    (6, add_answer_summaries),
+    (7, drop_answer_record_indexes),
+    (8, add_answer_time_index),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """把資料庫升級到最新版本，回傳實際套用的遷移版本列表
+
+    每個遷移在自己的交易中執行並一起更新 user_version；
+    多個行程同時啟動時，BEGIN IMMEDIATE 確保同一個遷移只會被套用一次。
+    """
+    applied = []
+    for version, migration in MIGRATIONS:
+        if get_version(conn) >= version:
+            continue
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 取得寫入鎖後重新確認，其他行程可能已經完成這個遷移
+            if get_version(conn) < version:
+                migration(conn.cursor())
+                conn.execute(f'PRAGMA user_version = {int(version)}')
+                applied.append(version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    return applied
@@ -0,0 +1,312 @@
+"""題庫快取：每個題庫只解析一次，檔案變動時才重新載入。
+
+大型題庫可以編譯成索引格式（.qidx 偏移索引 + .qrec 紀錄檔），
+以 mmap 隨機讀取單一題目，不需要把整個題庫解碼到記憶體。
+"""
+
+import bisect
+import json
+import mmap
+import os
+import random
+import struct
+import threading
+
+DATABASE_DIR = "database"
+
+# 編譯後題庫的檔案格式
+INDEX_SUFFIX = ".qidx"
+RECORD_SUFFIX = ".qrec"
+INDEX_MAGIC = b"QIDX"
+INDEX_VERSION = 1
+# magic, version, 保留, 題目數, ID 索引筆數
+INDEX_HEADER = struct.Struct("<4sHHQQ")
+OFFSET = struct.Struct("<Q")
+# 題目 ID, 紀錄序號
+ID_ENTRY = struct.Struct("<qQ")
+
+
+class QuestionBank:
+    """已載入記憶體的單一題庫"""
+
+    __slots__ = ("path", "signature", "questions", "by_id")
+
+    def __init__(self, path, signature, questions):
+        self.path = path
+        self.signature = signature  # (mtime_ns, size)，用於判斷檔案是否變動
+        self.questions = questions
+        self.by_id = {question["id"]: question for question in questions}
+
+    def __len__(self):
+        return len(self.questions)
+
+    def get(self, question_id):
+        """依題目 ID 取得題目，找不到時回傳 None"""
+        return self.by_id.get(question_id)
+
+    def random_question(self):
+        """隨機取得一道題目"""
+        if not self.questions:
+            return None
+        return random.choice(self.questions)
+
+
+class CompiledQuestionBank:
+    """以 mmap 讀取的編譯題庫，只在取用時解碼單一題目
+
+    .qidx 檔案內容依序為：標頭、題目數 + 1 個紀錄偏移量、依題目 ID 排序的
+    (ID, 紀錄序號) 表；.qrec 檔案為緊密排列的 UTF-8 JSON 紀錄。
+    """
+
+    __slots__ = (
+        "path",
+        "signature",
+        "_count",
+        "_id_count",
+        "_offsets_start",
+        "_ids_start",
+        "_index",
+        "_records",
+    )
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+
+        with open(path, "rb") as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self._count, self._id_count = INDEX_HEADER.unpack_from(
+            self._index, 0
+        )
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"不支援的題庫索引格式：{path}")
+
+        self._offsets_start = INDEX_HEADER.size
+        self._ids_start = self._offsets_start + (self._count + 1) * OFFSET.size
+
+        record_path = path[: -len(INDEX_SUFFIX)] + RECORD_SUFFIX
+        with open(record_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size != self._offset(self._count):
+                raise ValueError(f"題庫紀錄檔與索引不一致：{record_path}")
+            # 空檔案無法 mmap，沒有題目時不需要紀錄檔內容
+            self._records = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if self._count
+                else b""
+            )
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, position):
+        return OFFSET.unpack_from(
+            self._index, self._offsets_start + position * OFFSET.size
+        )[0]
+
+    def _id_entry(self, position):
+        return ID_ENTRY.unpack_from(
+            self._index, self._ids_start + position * ID_ENTRY.size
+        )
+
+    def record(self, position):
+        """解碼第 position 筆題目"""
+        start = self._offset(position)
+        end = self._offset(position + 1)
+        return json.loads(self._records[start:end])
+
+    def get(self, question_id):
+        """以二分搜尋在 ID 表中找出題目，找不到時回傳 None"""
+        if not isinstance(question_id, int):
+            return None
+        ids = _IdView(self)
+        position = bisect.bisect_left(ids, question_id)
+        if position < self._id_count and ids[position] == question_id:
+            return self.record(self._id_entry(position)[1])
+        return None
+
+    def random_question(self):
+        """隨機取得一道題目，只解碼被選中的那一筆"""
+        if not self._count:
+            return None
+        return self.record(random.randrange(self._count))
+
+
+class _IdView:
+    """讓 bisect 直接在 mmap 的 ID 表上搜尋"""
+
+    __slots__ = ("bank",)
+
+    def __init__(self, bank):
+        self.bank = bank
+
+    def __len__(self):
+        return self.bank._id_count
+
+    def __getitem__(self, position):
+        return self.bank._id_entry(position)[0]
+
+
+def compile_bank(json_path, output_prefix=None):
+    """將 {"questions": [...]} 格式的題庫編譯成索引格式
+
+    Args:
+        json_path: 原始題庫 JSON 路徑
+        output_prefix: 輸出檔案路徑（不含副檔名），預設與原始檔案相同
+    Returns:
+        編譯的題目數
+    """
+    if output_prefix is None:
+        output_prefix = json_path[:-5] if json_path.endswith(".json") else json_path
+
+    with open(json_path, "r", encoding="utf-8") as f:
+        questions = json.load(f).get("questions", [])
+
+    offsets = [0]
+    record_tmp = output_prefix + RECORD_SUFFIX + ".tmp"
+    with open(record_tmp, "wb") as f:
+        for question in questions:
+            record = json.dumps(
+                question, ensure_ascii=False, separators=(",", ":")
+            ).encode("utf-8")
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+
+    # 只有全部題目 ID 都是整數時才建立 ID 索引（重複 ID 以第一筆為準）
+    id_entries = []
+    if all(
+        isinstance(q.get("id"), int) and not isinstance(q.get("id"), bool)
+        for q in questions
+    ):
+        seen = set()
+        for position, question in enumerate(questions):
+            if question["id"] not in seen:
+                seen.add(question["id"])
+                id_entries.append((question["id"], position))
+        id_entries.sort()
+
+    index_tmp = output_prefix + INDEX_SUFFIX + ".tmp"
+    with open(index_tmp, "wb") as f:
+        f.write(
+            INDEX_HEADER.pack(
+                INDEX_MAGIC, INDEX_VERSION, 0, len(questions), len(id_entries)
+            )
+        )
+        for offset in offsets:
+            f.write(OFFSET.pack(offset))
+        for entry in id_entries:
+            f.write(ID_ENTRY.pack(*entry))
+
+    # 先替換紀錄檔再替換索引，索引的 mtime 代表編譯完成的時間
+    os.replace(record_tmp, output_prefix + RECORD_SUFFIX)
+    os.replace(index_tmp, output_prefix + INDEX_SUFFIX)
+    return len(questions)
+
+
+class QuestionBankRegistry:
+    """行程內共用的題庫登錄表
+
+    以檔案路徑為鍵快取已解析的題庫，每次存取時只做 os.stat，
+    mtime 或檔案大小改變時才重新解析。題庫有不比 JSON 舊的編譯索引時
+    會優先使用編譯格式，否則退回解析 JSON。
+    """
+
+    def __init__(self, directory=DATABASE_DIR):
+        self.directory = directory
+        self._banks = {}
+        self._listing = None  # (目錄簽章, 題庫名稱)
+        self._lock = threading.Lock()
+
+    def path_for(self, database_name):
+        return os.path.join(self.directory, f"{database_name}.json")
+
+    def compiled_path_for(self, database_name):
+        return os.path.join(self.directory, f"{database_name}{INDEX_SUFFIX}")
+
+    def directory_signature(self):
+        """題庫目錄的簽章，目錄內新增、刪除或更名檔案時會改變"""
+        return os.stat(self.directory).st_mtime_ns
+
+    def list_banks(self):
+        """依名稱排序列出所有題庫，目錄內容沒有變動時直接使用快取"""
+        signature = self.directory_signature()
+        listing = self._listing
+        if listing is not None and listing[0] == signature:
+            return listing[1]
+
+        names = set()
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".json"):
+                names.add(file_name[:-5])
+            elif file_name.endswith(INDEX_SUFFIX):
+                names.add(file_name[: -len(INDEX_SUFFIX)])
+        names = tuple(sorted(names))
+        self._listing = (signature, names)
+        return names
+
+    def get(self, database_name):
+        """取得指定題庫，檔案不存在時拋出 FileNotFoundError"""
+        json_path = self.path_for(database_name)
+        index_path = self.compiled_path_for(database_name)
+        try:
+            index_stat = os.stat(index_path)
+        except FileNotFoundError:
+            return self.get_file(json_path)
+
+        try:
+            json_mtime = os.stat(json_path).st_mtime_ns
+        except FileNotFoundError:
+            json_mtime = None
+
+        # 編譯後 JSON 又被修改時，編譯檔已過期，改用 JSON
+        if json_mtime is None or json_mtime <= index_stat.st_mtime_ns:
+            try:
+                return self._get_cached(index_path, index_stat, CompiledQuestionBank)
+            except (OSError, ValueError) as e:
+                if json_mtime is None:
+                    raise
+                print(f"Error loading compiled question bank: {e}")
+        return self.get_file(json_path)
+
+    def get_file(self, path):
+        """取得指定路徑的 JSON 題庫"""
+        return self._get_cached(path, os.stat(path), self._load)
+
+    def _get_cached(self, path, stat, loader):
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        bank = self._banks.get(path)
+        if bank is not None and bank.signature == signature:
+            return bank
+
+        with self._lock:
+            # 其他執行緒可能已經完成重新載入
+            bank = self._banks.get(path)
+            if bank is None or bank.signature != signature:
+                bank = loader(path, signature)
+                self._banks[path] = bank
+            return bank
+
+    def _load(self, path, signature):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return QuestionBank(path, signature, data.get("questions", []))
+
+    def random_question(self, database_name):
+        return self.get(database_name).random_question()
+
+    def count(self, database_name):
+        return len(self.get(database_name))
+
+    def invalidate(self, database_name=None):
+        """清除快取，未指定題庫時清除全部"""
+        with self._lock:
+            if database_name is None:
+                self._banks.clear()
+                self._listing = None
+            else:
+                self._banks.pop(self.path_for(database_name), None)
+                self._banks.pop(self.compiled_path_for(database_name), None)
+
+
+# 全行程共用的題庫登錄表
+question_banks = QuestionBankRegistry()
@@ -0,0 +1,118 @@
+"""預先序列化的回覆訊息快取，固定內容的回覆不必每次都經過 SDK 模型驗證與序列化。"""
+
+import json
+import threading
+from collections import OrderedDict
+
+from linebot.v3.messaging import ReplyMessageRequest
+from linebot.v3.messaging.async_rest import RESTResponse as AsyncRESTResponse
+from linebot.v3.messaging.exceptions import ApiException
+from linebot.v3.messaging.rest import RESTResponse
+
+REPLY_PATH = "/v2/bot/message/reply"
+LINE_API_HOST = "https://api.line.me"
+
+# 用來在 SDK 序列化結果中標記 reply token 位置的佔位字串
+_TOKEN_PLACEHOLDER = "\x00reply-token\x00"
+
+
+class ReplyPayloadCache:
+    """以訊息識別鍵快取已序列化的 ReplyMessageRequest
+
+    第一次使用某個鍵時，會用 SDK 的模型建立並序列化請求，
+    之後只需把 reply token 填入快取的 JSON 片段，產生的位元組與 SDK 完全相同。
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key: (source, prefix, suffix)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _serialize(self, api_client, messages):
+        request_body = api_client.sanitize_for_serialization(
+            ReplyMessageRequest(reply_token=_TOKEN_PLACEHOLDER, messages=messages)
+        )
+        prefix, suffix = json.dumps(request_body).split(json.dumps(_TOKEN_PLACEHOLDER))
+        return prefix, suffix
+
+    def body(self, api_client, reply_token, key, build_messages, source=None):
+        """取得指定 reply token 的請求內容
+
+        Args:
+            api_client: 用於序列化的 ApiClient
+            reply_token: 本次回覆的 reply token
+            key: 訊息識別鍵，相同的鍵代表相同的訊息內容
+            build_messages: 快取未命中時呼叫，回傳 SDK 訊息物件列表
+            source: 訊息內容來源物件（例如快取中的 carousel），
+                與快取時的物件不同時會重新序列化
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is source:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is None:
+            entry = (source, *self._serialize(api_client, build_messages()))
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        _, prefix, suffix = entry
+        return prefix + json.dumps(reply_token) + suffix
+
+    def reply(self, api_client, reply_token, key, build_messages, source=None):
+        """直接送出快取的回覆請求到 reply endpoint"""
+        body = self.body(api_client, reply_token, key, build_messages, source)
+        return send_reply_body(api_client, body)
+
+    async def reply_async(
+        self, api_client, reply_token, key, build_messages, source=None
+    ):
+        """以 AsyncApiClient 送出快取的回覆請求"""
+        body = self.body(api_client, reply_token, key, build_messages, source)
+        return await send_reply_body_async(api_client, body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def reply_url(api_client):
+    """reply endpoint 的網址，與 SDK 相同：有設定 configuration.host 時使用設定的主機"""
+    return (api_client.configuration.host or LINE_API_HOST) + REPLY_PATH
+
+
+def send_reply_body(api_client, body):
+    """使用 api_client 的連線池送出已序列化的回覆請求"""
+    headers = dict(api_client.default_headers)
+    headers["Accept"] = "application/json"
+    headers["Content-Type"] = "application/json"
+    response = api_client.rest_client.pool_manager.request(
+        "POST", reply_url(api_client), body=body, headers=headers
+    )
+    response = RESTResponse(response)
+    if not 200 <= response.status <= 299:
+        raise ApiException(http_resp=response)
+    return response
+
+
+async def send_reply_body_async(api_client, body):
+    """使用 AsyncApiClient 的 aiohttp session 送出已序列化的回覆請求"""
+    headers = dict(api_client.default_headers)
+    headers["Accept"] = "application/json"
+    headers["Content-Type"] = "application/json"
+    response = await api_client.rest_client.pool_manager.request(
+        "POST", reply_url(api_client), data=body.encode("utf-8"), headers=headers
+    )
+    response = AsyncRESTResponse(response, await response.read())
+    if not 200 <= response.status <= 299:
+        raise ApiException(http_resp=response)
+    return response
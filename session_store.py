@@ -0,0 +1,385 @@
+"""每位使用者的答題狀態，取代 app.py 中以全域變數保存的題目、選項與題庫。
+
+狀態可以保存在行程內（MemorySessionStore），也可以保存在多個 worker 行程共用的
+SQLite 檔案中（SQLiteSessionStore），讓同一位使用者的訊息由任何一個行程處理都能正確作答。
+"""
+
+import json
+import sys
+from abc import ABC, abstractmethod
+import threading
+import time
+from collections import OrderedDict
+
+from database import ConnectionManager
+from user_locks import StripedFileLock, UserLockManager
+
+
+def _deep_size(obj):
+    """估計題目資料佔用的記憶體（字典、列表與字串）"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _deep_size(key) + _deep_size(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            size += _deep_size(value)
+    return size
+
+
+class UserSession:
+    """單一使用者目前的答題狀態"""
+
+    __slots__ = (
+        "user_id",
+        "database_name",  # 目前的題庫
+        "question_data",  # 目前的題目（選項已打亂）
+        "answer",  # 打亂後的正確答案字母
+        "options",  # 多選題固定的選項順序，重新顯示題目時沿用
+        "selections",  # 多選題已選擇的選項字母，例如 "AC"
+        "is_wrong_question_practice",
+        "last_active",
+        "size",
+    )
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.database_name = None
+        self.question_data = None
+        self.answer = None
+        self.options = None
+        self.selections = ""
+        self.is_wrong_question_practice = False
+        self.last_active = time.monotonic()
+        self.size = 0
+
+    def toggle_selection(self, choice):
+        """選擇或取消選擇一個選項"""
+        if choice in self.selections:
+            self.selections = self.selections.replace(choice, "")
+        else:
+            self.selections = "".join(sorted(self.selections + choice))
+
+    def clear_question(self):
+        """作答完畢，清除目前的題目"""
+        self.question_data = None
+        self.answer = None
+
+    def to_bytes(self):
+        """精簡的序列化格式：固定的選項順序就是題目中的選項，只記錄是否固定"""
+        return json.dumps(
+            [
+                self.database_name,
+                self.question_data,
+                self.answer,
+                self.options is not None,
+                self.selections,
+                self.is_wrong_question_practice,
+            ],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode("utf-8")
+
+    @classmethod
+    def from_bytes(cls, user_id, data):
+        session = cls(user_id)
+        (
+            session.database_name,
+            session.question_data,
+            session.answer,
+            fixed_options,
+            session.selections,
+            session.is_wrong_question_practice,
+        ) = json.loads(data)
+        if fixed_options and session.question_data is not None:
+            session.options = session.question_data["options"]
+        return session
+
+    def estimate_size(self):
+        size = sys.getsizeof(self)
+        for attr in ("user_id", "database_name", "answer", "selections"):
+            size += sys.getsizeof(getattr(self, attr))
+        if self.question_data is not None:
+            size += _deep_size(self.question_data)
+        return size
+
+
+class SessionStore(ABC):
+    """答題狀態儲存的介面
+
+    處理一則訊息時以 update() 取得狀態並執行修改，修改完畢後自動儲存；
+    同一個行程中，同一位使用者的 update() 以 locks 中的鎖依序執行，
+    不同使用者的 update() 可以同時執行。
+    """
+
+    def __init__(self):
+        self.locks = UserLockManager()
+
+    @abstractmethod
+    def get(self, user_id):
+        """取得使用者的狀態，沒有時回傳新的空狀態"""
+
+    @abstractmethod
+    def save(self, session):
+        """儲存修改後的狀態"""
+
+    @abstractmethod
+    def discard(self, user_id):
+        """移除使用者的狀態"""
+
+    def update(self, user_id, fn):
+        """讀取使用者的狀態、呼叫 fn(session) 修改並儲存，回傳 fn 的結果
+
+        fn 拋出例外時，已經做出的修改仍會被儲存（與原本處理訊息的行為相同）。
+        """
+        with self.locks.hold(user_id):
+            return self._update(user_id, fn)
+
+    def _update(self, user_id, fn):
+        session = self.get(user_id)
+        try:
+            return fn(session)
+        finally:
+            self.save(session)
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """行程內、有容量上限的答題狀態儲存
+
+    最久未使用的狀態會在超過 max_sessions 個或估計記憶體超過 max_bytes 時移除，
+    閒置超過 idle_ttl 秒的狀態也會被移除。只適用於單一 worker 行程。
+    """
+
+    def __init__(self, max_sessions=10000, idle_ttl=1800, max_bytes=64 * 1024 * 1024):
+        super().__init__()
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()  # user_id: UserSession，依最後使用時間排序
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+        # 監控數據
+        self.hits = 0
+        self.misses = 0
+        self.evicted_idle = 0
+        self.evicted_capacity = 0
+
+    def _remove(self, user_id):
+        session = self._sessions.pop(user_id)
+        self.total_bytes -= session.size
+
+    def _evict_idle(self, now):
+        # 依最後使用時間排序，只需要檢查最前面的狀態
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session.last_active < self.idle_ttl:
+                break
+            self._remove(user_id)
+            self.evicted_idle += 1
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            session = self._sessions.get(user_id)
+            if session is not None:
+                self._sessions.move_to_end(user_id)
+                session.last_active = now
+                self.hits += 1
+                return session
+            self.misses += 1
+        return UserSession(user_id)
+
+    def save(self, session):
+        """儲存狀態並重新計算記憶體用量"""
+        if session.user_id is None:
+            return
+        size = session.estimate_size()
+        with self._lock:
+            if session.user_id in self._sessions:
+                self._remove(session.user_id)
+            session.size = size
+            session.last_active = time.monotonic()
+            self._sessions[session.user_id] = session
+            self.total_bytes += size
+
+            while len(self._sessions) > 1 and (
+                len(self._sessions) > self.max_sessions
+                or self.total_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._sessions)))
+                self.evicted_capacity += 1
+
+    def discard(self, user_id):
+        with self._lock:
+            if user_id in self._sessions:
+                self._remove(user_id)
+
+    def stats(self):
+        """狀態數量、估計記憶體用量與移除次數"""
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted_idle": self.evicted_idle,
+                "evicted_capacity": self.evicted_capacity,
+                "locks": self.locks.stats(),
+            }
+
+
+class SQLiteSessionStore(SessionStore):
+    """多個 worker 行程共用的 SQLite 答題狀態儲存
+
+    update() 持有使用者的跨行程鎖檔（file_locks）完成讀取、修改與寫入，
+    同一位使用者同一時間只有一個請求能修改狀態，多選題連續點選不會遺失任何一次選擇；
+    讀取與寫入各自是很短的交易，處理訊息期間不佔用 SQLite 的寫入鎖，不同使用者可以同時處理。
+    同一個行程中同一位使用者的請求會先以行程內的鎖排隊，不會同時等待鎖檔。
+    每 cleanup_interval 次寫入會移除閒置超過 idle_ttl 秒或超過 max_sessions 個的狀態。
+    """
+
+    def __init__(
+        self,
+        db_file="sessions.db",
+        max_sessions=100000,
+        idle_ttl=1800,
+        busy_timeout=5000,
+        cleanup_interval=1000,
+        lock_stripes=64,
+    ):
+        self.db_file = db_file
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.cleanup_interval = cleanup_interval
+        super().__init__()
+        self.connections = ConnectionManager(db_file, busy_timeout)
+        self.file_locks = StripedFileLock(f"{db_file}-locks", lock_stripes)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        # 監控數據
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        with self.connections.get() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    user_id TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    last_active REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_sessions_last_active ON sessions (last_active)"
+            )
+
+    def _load(self, conn, user_id):
+        row = conn.execute(
+            "SELECT data, last_active FROM sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        with self._lock:
+            if row is None or time.time() - row[1] >= self.idle_ttl:
+                self.misses += 1
+                return UserSession(user_id)
+            self.hits += 1
+        return UserSession.from_bytes(user_id, row[0])
+
+    def _store(self, conn, session):
+        conn.execute(
+            """
+            INSERT INTO sessions (user_id, data, last_active) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                data = excluded.data,
+                last_active = excluded.last_active
+            """,
+            (session.user_id, session.to_bytes(), time.time()),
+        )
+
+    def get(self, user_id):
+        return self._load(self.connections.get(), user_id)
+
+    def save(self, session):
+        if session.user_id is None:
+            return
+        with self.connections.get() as conn:
+            self._store(conn, session)
+        self._after_write()
+
+    def _update(self, user_id, fn):
+        with self.file_locks.hold(user_id):
+            return super()._update(user_id, fn)
+
+    def _after_write(self):
+        with self._lock:
+            self._writes += 1
+            if self._writes % self.cleanup_interval:
+                return
+        self.cleanup()
+
+    def cleanup(self):
+        """移除閒置過久或超過數量上限的狀態"""
+        with self.connections.get() as conn:
+            cursor = conn.execute(
+                "DELETE FROM sessions WHERE last_active < ?",
+                (time.time() - self.idle_ttl,),
+            )
+            evicted = cursor.rowcount
+            cursor = conn.execute(
+                """
+                DELETE FROM sessions WHERE user_id IN (
+                    SELECT user_id FROM sessions
+                    ORDER BY last_active DESC
+                    LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_sessions,),
+            )
+            evicted += cursor.rowcount
+        with self._lock:
+            self.evicted += evicted
+
+    def discard(self, user_id):
+        with self.connections.get() as conn:
+            conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def stats(self):
+        """狀態數量、序列化後的總大小與命中次數"""
+        row = (
+            self.connections.get()
+            .execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM sessions")
+            .fetchone()
+        )
+        with self._lock:
+            return {
+                "sessions": row[0],
+                "max_sessions": self.max_sessions,
+                "bytes": row[1],
+                "hits": self.hits,
+                "misses": self.misses,
+                "evicted": self.evicted,
+                "locks": self.locks.stats(),
+            }
+
+    def close(self):
+        self.connections.close_all()
+
+
+def create_session_store(backend="memory", **options):
+    """依設定建立答題狀態儲存：memory（單一行程）或 sqlite（多個行程共用）"""
+    if backend == "sqlite":
+        return SQLiteSessionStore(**options)
+    if backend == "memory":
+        return MemorySessionStore(**options)
+    raise ValueError(f"Unknown session backend: {backend}")
@@ -0,0 +1,167 @@
+"""依使用者分散到多個 SQLite 檔案的資料庫，讓寫入量可以隨分片數增加。"""
+
+import os
+import zlib
+
+from database import Database
+from migrations import rebuild_question_stats
+
+# 分片之間不共用的資料表，依 user_id 分配到各個分片
+USER_TABLES = (
+    "user_states",
+    "answer_records",
+    "wrong_questions",
+    "user_question_progress",
+    "user_bank_stats",
+    "answer_summaries",
+)
+
+
+def shard_index(user_id, shards):
+    """使用者所屬的分片（與行程無關的穩定雜湊）"""
+    return zlib.crc32(str(user_id).encode("utf-8")) % shards
+
+
+def shard_paths(db_file, shards):
+    """user_records.db 分成 4 片時為 user_records.0.db ... user_records.3.db"""
+    root, ext = os.path.splitext(db_file)
+    return [f"{root}.{i}{ext}" for i in range(shards)]
+
+
+class ShardedDatabase:
+    """與 Database 相同介面的分片資料庫
+
+    每位使用者的資料只存在一個分片中，個人的查詢與寫入只會使用該分片；
+    每題的作答次數分散在所有分片，查詢時加總各分片的結果。
+    """
+
+    def __init__(self, db_file="user_records.db", shards=4, **options):
+        self.db_file = db_file
+        self.paths = shard_paths(db_file, shards)
+        self.shards = [Database(path, **options) for path in self.paths]
+
+    def shard(self, user_id):
+        return self.shards[shard_index(user_id, len(self.shards))]
+
+    def update_user_state(self, user_id, database_name):
+        return self.shard(user_id).update_user_state(user_id, database_name)
+
+    def get_user_state(self, user_id):
+        return self.shard(user_id).get_user_state(user_id)
+
+    def record_answer(
+        self,
+        user_id,
+        question_data,
+        user_answer,
+        is_correct,
+        database_name,
+        is_wrong_question_practice=False,
+    ):
+        return self.shard(user_id).record_answer(
+            user_id,
+            question_data,
+            user_answer,
+            is_correct,
+            database_name,
+            is_wrong_question_practice,
+        )
+
+    def wait_for_writes(self, user_id):
+        return self.shard(user_id).wait_for_writes(user_id)
+
+    def get_wrong_questions(self, user_id, database_name=None, limit=10):
+        return self.shard(user_id).get_wrong_questions(user_id, database_name, limit)
+
+    def get_user_statistics(self, user_id, database_name):
+        return self.shard(user_id).get_user_statistics(user_id, database_name)
+
+    def get_total_questions(self, database_name):
+        return self.shards[0].get_total_questions(database_name)
+
+    def get_question_attempt_stats(self, question_id, database_name):
+        """加總所有分片中這一題的作答次數"""
+        total = {"total_attempts": 0, "correct_attempts": 0}
+        for shard in self.shards:
+            stats = shard.get_question_attempt_stats(question_id, database_name)
+            total["total_attempts"] += stats["total_attempts"]
+            total["correct_attempts"] += stats["correct_attempts"]
+        return total
+
+    def rebuild_stats(self):
+        for shard in self.shards:
+            shard.rebuild_stats()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def reshard(sources, db_file, shards):
+    """把一個或多個既有的資料庫檔案重新分配到 shards 個分片
+
+    sources 可以是原本的單一 user_records.db，也可以是舊的分片檔案。
+    目標檔案不能已經存在。回傳每個分片的 (使用者數, 答題記錄數)。
+    """
+    paths = shard_paths(db_file, shards)
+    existing = [path for path in paths if os.path.exists(path)]
+    if existing:
+        raise FileExistsError(f"Shard files already exist: {', '.join(existing)}")
+
+    # 先把來源升級到最新的資料表結構，欄位順序才會與分片相同
+    for source in sources:
+        Database(source).close()
+
+    target = ShardedDatabase(db_file, shards)
+    try:
+        for index, shard in enumerate(target.shards):
+            conn = shard.get_connection()
+            conn.create_function("shard_index", 2, shard_index, deterministic=True)
+            for source in sources:
+                conn.execute("ATTACH DATABASE ? AS source", (source,))
+                try:
+                    with conn:
+                        for table in USER_TABLES:
+                            # 答題記錄的 id 由分片重新編號，避免多個來源的 id 重複
+                            columns = ", ".join(
+                                row[1]
+                                for row in conn.execute(
+                                    f"PRAGMA main.table_info({table})"
+                                )
+                                if row[1] != "id"
+                            )
+                            conn.execute(
+                                f"""
+                                INSERT INTO main.{table} ({columns})
+                                SELECT {columns} FROM source.{table}
+                                WHERE shard_index(user_id, ?) = ?
+                            """,
+                                (shards, index),
+                            )
+
+                        # 只複製這個分片的答題記錄與錯題參照到的題目內容
+                        conn.execute("""
+                            INSERT OR IGNORE INTO main.question_snapshots
+                            SELECT * FROM source.question_snapshots
+                            WHERE snapshot_hash IN (
+                                SELECT snapshot_hash FROM main.answer_records
+                                UNION
+                                SELECT snapshot_hash FROM main.wrong_questions
+                            )
+                        """)
+                finally:
+                    conn.execute("DETACH DATABASE source")
+
+        # 每題作答次數依分片中的答題記錄重新計算
+        counts = []
+        for shard in target.shards:
+            with shard.get_connection() as conn:
+                rebuild_question_stats(conn.cursor())
+                users = conn.execute("SELECT COUNT(*) FROM user_states").fetchone()[0]
+                answers = conn.execute(
+                    "SELECT COUNT(*) FROM answer_records"
+                ).fetchone()[0]
+            counts.append((users, answers))
+        return counts
+    finally:
+        target.close()
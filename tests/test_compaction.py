@@ -0,0 +1,100 @@
+"""答題記錄壓縮與統計重建：python -m unittest discover tests"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compaction import compact  # noqa: E402
+from database import Database  # noqa: E402
+
+BANK = "example"
+
+
+def question(question_id):
+    return {"id": question_id, "answer": "A", "options": {"A": "甲", "B": "乙"}}
+
+
+class CompactionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.directory.name, "records.db"))
+        answers = [
+            ("U1", 1, False, False),
+            ("U1", 1, True, False),
+            ("U1", 2, False, False),
+            ("U1", 2, True, True),
+            ("U2", 1, True, False),
+            ("U2", 3, False, False),
+        ]
+        for user_id, question_id, is_correct, practice in answers:
+            self.db.record_answer(
+                user_id,
+                question(question_id),
+                "A" if is_correct else "B",
+                is_correct,
+                BANK,
+                is_wrong_question_practice=practice,
+            )
+        # 前四筆超過保存期限
+        with self.db.get_connection() as conn:
+            conn.execute(
+                "UPDATE answer_records SET answer_time = '2020-01-01 00:00:00' "
+                "WHERE id <= 4"
+            )
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def snapshot(self):
+        return {
+            "stats": [self.db.get_user_statistics(u, BANK) for u in ("U1", "U2")],
+            "attempts": [
+                self.db.get_question_attempt_stats(q, BANK) for q in (1, 2, 3)
+            ],
+            "wrong": [
+                sorted(
+                    (w["question_id"], w["wrong_count"], w["question_data"]["id"])
+                    for w in self.db.get_wrong_questions(u, BANK)
+                )
+                for u in ("U1", "U2")
+            ],
+        }
+
+    def count(self, table):
+        conn = self.db.get_connection()
+        return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def test_compaction_keeps_statistics(self):
+        before = self.snapshot()
+
+        result = compact(self.db, retention_days=30, batch_size=2)
+
+        self.assertEqual(result["compacted"], 4)
+        self.assertEqual(self.count("answer_records"), 2)
+        # U1 的 (題目 1)、(題目 2)、(題目 2 錯題練習)
+        self.assertEqual(self.count("answer_summaries"), 3)
+        self.assertEqual(self.snapshot(), before)
+
+        # 重新計算統計時包含摘要，結果不變
+        self.db.rebuild_stats()
+        self.assertEqual(self.snapshot(), before)
+
+        # 再次壓縮沒有新的記錄
+        self.assertEqual(compact(self.db, retention_days=30)["compacted"], 0)
+        self.assertEqual(self.snapshot(), before)
+
+    def test_scheduler_mode_never_runs_full_vacuum(self):
+        conn = self.db.get_connection()
+        compact(self.db, retention_days=30, full_vacuum=False)
+        self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 0)
+
+        compact(self.db, retention_days=30)
+        self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""資料庫結構遷移：python -m unittest discover tests"""
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+from migrations import SCHEMA_VERSION, create_base_tables, get_version, migrate  # noqa: E402
+
+BANK = "example"
+
+
+def question(question_id, answer="A"):
+    return {"id": question_id, "answer": answer, "options": {"A": "甲", "B": "乙"}}
+
+
+def indexes(conn):
+    return {
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = 'answer_records' AND sql IS NOT NULL"
+        )
+    }
+
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "records.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_legacy_database(self):
+        """原本的資料表：每筆答題記錄都存一份題目 JSON，沒有統計表"""
+        conn = sqlite3.connect(self.path)
+        create_base_tables(conn.cursor())
+        rows = [
+            # user, question, answer, correct, time, practice
+            ("U1", 1, "B", False, "2024-01-01 10:00:00", False),
+            ("U1", 1, "A", True, "2024-01-01 10:01:00", False),
+            ("U1", 2, "B", False, "2024-01-01 10:02:00", False),
+            ("U1", 2, "A", True, "2024-01-01 10:03:00", True),
+            ("U2", 1, "A", True, "2024-01-01 10:04:00", False),
+        ]
+        conn.executemany(
+            """
+            INSERT INTO answer_records
+            (user_id, question_id, database_name, user_answer, correct_answer,
+             is_correct, answer_time, question_data, is_wrong_question_practice)
+            VALUES (?, ?, ?, ?, 'A', ?, ?, ?, ?)
+            """,
+            [
+                (user, qid, BANK, answer, correct, time, json.dumps(question(qid)), p)
+                for user, qid, answer, correct, time, p in rows
+            ],
+        )
+        conn.executemany(
+            """
+            INSERT INTO wrong_questions
+            (user_id, question_id, database_name, wrong_count, last_wrong_time)
+            VALUES ('U1', ?, ?, 1, ?)
+            """,
+            [(1, BANK, "2024-01-01 10:00:00"), (2, BANK, "2024-01-01 10:02:00")],
+        )
+        conn.execute("INSERT INTO user_states VALUES ('U1', ?, '2024-01-01')", (BANK,))
+        conn.commit()
+        conn.close()
+
+    def test_new_database_is_created_at_latest_version(self):
+        db = Database(self.path)
+        try:
+            conn = db.get_connection()
+            self.assertEqual(get_version(conn), SCHEMA_VERSION)
+            self.assertEqual(indexes(conn), {"idx_answer_records_time"})
+            self.assertEqual(migrate(conn), [])
+        finally:
+            db.close()
+
+    def test_legacy_database_is_upgraded_in_place(self):
+        self.create_legacy_database()
+        db = Database(self.path)
+        try:
+            conn = db.get_connection()
+            self.assertEqual(get_version(conn), SCHEMA_VERSION)
+            self.assertEqual(indexes(conn), {"idx_answer_records_time"})
+
+            # 題目內容去除重複後只留下兩份，答題記錄只保留雜湊
+            self.assertEqual(
+                conn.execute("SELECT COUNT(*) FROM question_snapshots").fetchone()[0], 2
+            )
+            self.assertEqual(
+                conn.execute(
+                    "SELECT COUNT(*) FROM answer_records "
+                    "WHERE question_data IS NOT NULL OR snapshot_hash IS NULL"
+                ).fetchone()[0],
+                0,
+            )
+
+            stats = db.get_user_statistics("U1", BANK)
+            self.assertEqual(stats["total_answers"], 2)
+            self.assertEqual(stats["correct_answers"], 1)
+            self.assertEqual(stats["total_wrong_questions"], 2)
+            self.assertEqual(stats["practice_count"], 1)
+            self.assertEqual(stats["practice_correct"], 1)
+
+            # 錯題練習不計入每題的作答次數
+            self.assertEqual(
+                db.get_question_attempt_stats(1, BANK),
+                {"total_attempts": 3, "correct_attempts": 2},
+            )
+            self.assertEqual(
+                db.get_question_attempt_stats(2, BANK),
+                {"total_attempts": 1, "correct_attempts": 0},
+            )
+
+            wrong = db.get_wrong_questions("U1", BANK)
+            self.assertEqual(sorted(w["question_data"]["id"] for w in wrong), [1, 2])
+            self.assertEqual(db.get_user_state("U1"), BANK)
+        finally:
+            db.close()
+
+    def test_upgrade_from_intermediate_version(self):
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        create_base_tables(conn.cursor())
+        conn.execute("PRAGMA user_version = 1")
+        conn.close()
+
+        db = Database(self.path)
+        try:
+            self.assertEqual(get_version(db.get_connection()), SCHEMA_VERSION)
+            db.record_answer("U1", question(1), "A", True, BANK)
+            self.assertEqual(db.get_user_statistics("U1", BANK)["correct_answers"], 1)
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+"""編譯後的題庫格式：python -m unittest discover tests"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from question_bank import (  # noqa: E402
+    INDEX_SUFFIX,
+    CompiledQuestionBank,
+    QuestionBankRegistry,
+    compile_bank,
+)
+
+
+class CompiledQuestionBankTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_bank(self, name, questions):
+        path = os.path.join(self.directory.name, f"{name}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"questions": questions}, f, ensure_ascii=False)
+        return path
+
+    def load(self, path):
+        index_path = path[:-5] + INDEX_SUFFIX
+        return CompiledQuestionBank(index_path, None)
+
+    def test_compiled_bank_matches_json(self):
+        questions = [
+            {"id": question_id, "answer": "A", "question_text": f"第 {question_id} 題"}
+            for question_id in (5, 1, 9, 3)
+        ]
+        path = self.write_bank("bank", questions)
+
+        self.assertEqual(compile_bank(path), 4)
+        bank = self.load(path)
+        self.assertEqual(len(bank), 4)
+        for position, question in enumerate(questions):
+            self.assertEqual(bank.record(position), question)
+            self.assertEqual(bank.get(question["id"]), question)
+        self.assertIsNone(bank.get(2))
+        self.assertIsNone(bank.get("1"))
+        self.assertIn(bank.random_question(), questions)
+
+    def test_non_integer_ids_have_no_id_index(self):
+        questions = [{"id": "a", "answer": "A"}, {"id": "b", "answer": "B"}]
+        path = self.write_bank("text_ids", questions)
+        compile_bank(path)
+
+        bank = self.load(path)
+        self.assertEqual(len(bank), 2)
+        self.assertIsNone(bank.get("a"))
+        self.assertIn(bank.random_question(), questions)
+
+    def test_empty_bank(self):
+        path = self.write_bank("empty", [])
+        compile_bank(path)
+
+        bank = self.load(path)
+        self.assertEqual(len(bank), 0)
+        self.assertIsNone(bank.random_question())
+
+    def test_registry_uses_compiled_bank(self):
+        questions = [{"id": 1, "answer": "A"}, {"id": 2, "answer": "B"}]
+        compile_bank(self.write_bank("bank", questions))
+
+        registry = QuestionBankRegistry(self.directory.name)
+        self.assertIn("bank", registry.list_banks())
+        self.assertIsInstance(registry.get("bank"), CompiledQuestionBank)
+        self.assertEqual(registry.count("bank"), 2)
+        self.assertEqual(registry.get("bank").get(2), questions[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""答題狀態儲存與使用者鎖：python -m unittest discover tests"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_store import (  # noqa: E402
+    MemorySessionStore,
+    SessionStore,
+    SQLiteSessionStore,
+)
+
+
+def toggle_slowly(session):
+    selections = session.selections
+    time.sleep(0.001)
+    session.selections = "" if selections else "A"
+
+
+class SessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def stores(self):
+        return [
+            MemorySessionStore(),
+            SQLiteSessionStore(os.path.join(self.directory.name, "sessions.db")),
+        ]
+
+    def test_interface_is_abstract(self):
+        with self.assertRaises(TypeError):
+            SessionStore()
+
+    def test_updates_of_one_user_do_not_lose_changes(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+                # 奇數次切換後必須是選擇狀態
+                threads = [
+                    threading.Thread(
+                        target=lambda: [
+                            store.update("U1", toggle_slowly) for _ in range(7)
+                        ]
+                    )
+                    for _ in range(5)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(store.get("U1").selections, "A")
+                store.close()
+
+    def test_sqlite_updates_of_different_users_run_in_parallel(self):
+        store = self.stores()[1]
+        threads = [
+            threading.Thread(
+                target=store.update,
+                args=(f"U{i}", lambda session: time.sleep(0.1)),
+            )
+            for i in range(8)
+        ]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.monotonic() - started, 0.5)
+        store.close()
+
+    def test_changes_are_saved_when_fn_raises(self):
+        for store in self.stores():
+            with self.subTest(store=type(store).__name__):
+
+                def fail(session):
+                    session.database_name = "example"
+                    raise ValueError("boom")
+
+                with self.assertRaises(ValueError):
+                    store.update("U2", fail)
+                self.assertEqual(store.get("U2").database_name, "example")
+                store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
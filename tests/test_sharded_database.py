@@ -0,0 +1,70 @@
+"""分片資料庫與重新分片：python -m unittest discover tests"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+from sharded_database import ShardedDatabase, reshard, shard_index  # noqa: E402
+
+BANK = "example"
+USERS = [f"U{i}" for i in range(12)]
+
+
+def question(question_id):
+    return {"id": question_id, "answer": "A", "options": {"A": "甲", "B": "乙"}}
+
+
+class ReshardTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "records.db")
+        db = Database(self.source)
+        for n, user_id in enumerate(USERS):
+            db.update_user_state(user_id, BANK)
+            for question_id in range(1, n % 4 + 2):
+                is_correct = (n + question_id) % 2 == 0
+                db.record_answer(user_id, question(question_id), "A", is_correct, BANK)
+        self.expected = self.read(db)
+        db.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, db):
+        return {
+            "stats": {u: db.get_user_statistics(u, BANK) for u in USERS},
+            "wrong": {
+                u: sorted(w["question_id"] for w in db.get_wrong_questions(u, BANK))
+                for u in USERS
+            },
+            "states": {u: db.get_user_state(u) for u in USERS},
+            "attempts": [db.get_question_attempt_stats(q, BANK) for q in range(1, 5)],
+        }
+
+    def test_reshard_keeps_every_users_data(self):
+        target = os.path.join(self.directory.name, "sharded.db")
+        counts = reshard([self.source], target, 3)
+
+        self.assertEqual(sum(users for users, _ in counts), len(USERS))
+        sharded = ShardedDatabase(target, 3)
+        try:
+            self.assertEqual(self.read(sharded), self.expected)
+            for user_id in USERS:
+                shard = sharded.shards[shard_index(user_id, 3)]
+                self.assertEqual(shard.get_user_state(user_id), BANK)
+        finally:
+            sharded.close()
+
+    def test_reshard_refuses_existing_files(self):
+        target = os.path.join(self.directory.name, "sharded.db")
+        reshard([self.source], target, 2)
+        with self.assertRaises(FileExistsError):
+            reshard([self.source], target, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+"""依使用者保序的事件派送：python -m unittest discover tests"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from linebot.v3.webhooks import MessageEvent, TextMessageContent  # noqa: E402
+
+from webhook_worker import DispatchingWebhookHandler, KeyedExecutor  # noqa: E402
+
+SECRET = "secret"
+
+
+def message_event(user_id, text):
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": 1,
+        "webhookEventId": f"{user_id}-{text}",
+        "deliveryContext": {"isRedelivery": False},
+        "source": {"type": "user", "userId": user_id},
+        "replyToken": f"rt-{user_id}-{text}",
+        "message": {"type": "text", "id": "1", "text": text, "quoteToken": "q"},
+    }
+
+
+def signed_body(events):
+    body = json.dumps({"destination": "D", "events": events})
+    digest = hmac.new(SECRET.encode(), body.encode(), hashlib.sha256).digest()
+    return body, base64.b64encode(digest).decode()
+
+
+class KeyedExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = KeyedExecutor(4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_same_key_runs_in_submission_order_and_never_concurrently(self):
+        results = {key: [] for key in "abcdef"}
+        running = set()
+        overlaps = []
+        lock = threading.Lock()
+
+        def work(key, n):
+            with lock:
+                if key in running:
+                    overlaps.append(key)
+                running.add(key)
+            time.sleep(random.random() / 1000)
+            results[key].append(n)
+            with lock:
+                running.discard(key)
+
+        futures = [
+            self.executor.submit(key, work, key, n)
+            for n in range(50)
+            for key in results
+        ]
+        for future in futures:
+            future.result(timeout=10)
+
+        self.assertEqual(overlaps, [])
+        for key, values in results.items():
+            self.assertEqual(values, list(range(50)), key)
+        self.assertEqual(self.executor.pending_keys(), 0)
+
+    def test_different_keys_run_in_parallel(self):
+        started = time.monotonic()
+        futures = [self.executor.submit(key, time.sleep, 0.1) for key in "abcd"]
+        for future in futures:
+            future.result(timeout=10)
+        self.assertLess(time.monotonic() - started, 0.3)
+
+    def test_failure_does_not_stop_later_work_of_the_key(self):
+        def fail():
+            raise ValueError("boom")
+
+        failed = self.executor.submit("a", fail)
+        later = self.executor.submit("a", lambda: "done")
+        self.assertIsInstance(failed.exception(timeout=10), ValueError)
+        self.assertEqual(later.result(timeout=10), "done")
+
+
+class DispatchingWebhookHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = KeyedExecutor(4)
+        self.handler = DispatchingWebhookHandler(SECRET, executor=self.executor)
+        self.handled = []
+
+        @self.handler.add(MessageEvent, message=TextMessageContent)
+        def handle_message(event):
+            if event.message.text == "選擇 A":
+                time.sleep(0.2)
+            self.handled.append((event.source.user_id, event.message.text))
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_single_event_waits_for_concurrent_delivery_of_same_user(self):
+        first = threading.Thread(
+            target=self.handler.handle,
+            args=signed_body(
+                [message_event("U1", "選擇 A"), message_event("U1", "選擇 B")]
+            ),
+        )
+        first.start()
+        time.sleep(0.05)
+        # 只有一個事件的請求也必須排在同一位使用者處理中的事件之後
+        self.handler.handle(*signed_body([message_event("U1", "送出答案")]))
+        first.join()
+
+        self.assertEqual(
+            [text for _, text in self.handled], ["選擇 A", "選擇 B", "送出答案"]
+        )
+
+    def test_different_users_run_in_parallel(self):
+        body = signed_body(
+            [message_event(f"U{i}", "選擇 A") for i in range(4)]
+            + [message_event("U0", "送出答案")]
+        )
+        started = time.monotonic()
+        self.handler.handle(*body)
+
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual(len(self.handled), 5)
+        self.assertLess(
+            self.handled.index(("U0", "選擇 A")), self.handled.index(("U0", "送出答案"))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""WriteBehindQueue 的批次寫入與失敗處理：python -m unittest discover tests"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+from write_behind import WriteBehindQueue  # noqa: E402
+
+
+class FakeWriter:
+    """模擬資料庫寫入：批次中有 "poison" 的資料列時整個批次失敗"""
+
+    def __init__(self):
+        self.rows = []
+        self.lock = threading.Lock()
+
+    def __call__(self, rows):
+        if "poison" in rows:
+            raise ValueError("cannot write poison")
+        with self.lock:
+            self.rows.extend(rows)
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+    def test_poison_row_is_dropped_without_blocking_queue(self):
+        writer = FakeWriter()
+        queue = WriteBehindQueue(writer, flush_interval=0.01, max_retries=2)
+        try:
+            queue.put("U1", "a")
+            queue.put("U1", "poison")
+            queue.put("U2", "b")
+            self.assertTrue(queue.flush(timeout=5))
+
+            # 之後的資料列與其他使用者不會被擋住
+            queue.put("U2", "c")
+            start = time.monotonic()
+            queue.wait_user("U2")
+            self.assertLess(time.monotonic() - start, 5)
+
+            self.assertEqual(writer.rows, ["a", "b", "c"])
+            stats = queue.stats()
+            self.assertEqual(stats["dropped"], 1)
+            self.assertEqual(stats["rows_written"], 3)
+            self.assertEqual(stats["pending"], 0)
+        finally:
+            queue.close()
+
+    def test_transient_failure_is_retried(self):
+        writer = FakeWriter()
+        failures = [ValueError("database is locked")] * 2
+
+        def flaky(rows):
+            if failures:
+                raise failures.pop()
+            writer(rows)
+
+        queue = WriteBehindQueue(flaky, flush_interval=0.01, max_retries=3)
+        try:
+            queue.put("U1", "a")
+            queue.put("U1", "b")
+            self.assertTrue(queue.flush(timeout=5))
+            self.assertEqual(writer.rows, ["a", "b"])
+            self.assertEqual(queue.stats()["dropped"], 0)
+        finally:
+            queue.close()
+
+
+class DatabaseWriteBehindTest(unittest.TestCase):
+    def test_unbindable_question_id_does_not_block_other_answers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db = Database(
+                os.path.join(directory, "records.db"),
+                write_behind=True,
+                flush_interval=0.01,
+            )
+            try:
+                db.record_answer("U1", {"id": [1], "answer": "A"}, "A", True, "bank")
+                db.record_answer("U2", {"id": 1, "answer": "A"}, "A", True, "bank")
+                stats = db.get_user_statistics("U2", "bank")
+                self.assertEqual(stats["total_answers"], 1)
+                self.assertEqual(db.write_queue.stats()["dropped"], 1)
+            finally:
+                db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
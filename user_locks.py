@@ -0,0 +1,120 @@
+"""每位使用者一把的鎖：同一位使用者的請求依序處理，不同使用者的請求互不影響。"""
+
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只能以單一行程執行
+    fcntl = None
+
+
+class _UserLock:
+    __slots__ = ("lock", "holders")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holders = 0  # 持有或正在等待這把鎖的執行緒數
+
+
+class UserLockManager:
+    """以 user_id 區分的鎖
+
+    只保留有執行緒持有或等待中的鎖，最後一個使用者釋放後立即移除，
+    記憶體用量只與同時處理中的使用者數有關。stats() 提供等待鎖的次數與時間。
+    """
+
+    def __init__(self):
+        self._locks = {}  # user_id: _UserLock
+        self._lock = threading.Lock()
+
+        # 監控數據
+        self.acquired = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_active = 0
+
+    @contextmanager
+    def hold(self, user_id):
+        """在 with 區塊中持有使用者的鎖"""
+        with self._lock:
+            entry = self._locks.get(user_id)
+            if entry is None:
+                entry = self._locks[user_id] = _UserLock()
+                self.max_active = max(self.max_active, len(self._locks))
+            entry.holders += 1
+
+        started = time.monotonic()
+        contended = not entry.lock.acquire(blocking=False)
+        if contended:
+            entry.lock.acquire()
+        wait = time.monotonic() - started
+
+        with self._lock:
+            self.acquired += 1
+            if contended:
+                self.contended += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+        try:
+            yield
+        finally:
+            entry.lock.release()
+            with self._lock:
+                entry.holders -= 1
+                if entry.holders == 0:
+                    del self._locks[user_id]
+
+    def stats(self):
+        """使用中的鎖數量、等待次數與等待時間"""
+        with self._lock:
+            return {
+                "active": len(self._locks),
+                "max_active": self.max_active,
+                "acquired": self.acquired,
+                "contended": self.contended,
+                "avg_wait_ms": self.total_wait / self.contended * 1000
+                if self.contended
+                else 0,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+
+class StripedFileLock:
+    """跨行程的使用者鎖
+
+    以 user_id 的雜湊選出 stripes 個鎖檔中的一個，以 flock 鎖住整個檔案：
+    不同 worker 行程中同一位使用者的請求依序執行，雜湊到同一個鎖檔的其他使用者也會等待。
+    每次鎖定都開啟新的檔案，同一個行程的不同執行緒之間同樣互斥。
+    沒有 fcntl 的平台不鎖定。
+    """
+
+    def __init__(self, directory, stripes=64):
+        self.directory = directory
+        self.stripes = stripes
+        if fcntl is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, user_id):
+        stripe = zlib.crc32(str(user_id).encode("utf-8")) % self.stripes
+        return os.path.join(self.directory, f"{stripe}.lock")
+
+    @contextmanager
+    def hold(self, user_id):
+        """在 with 區塊中持有使用者所在的鎖檔"""
+        if fcntl is None:
+            yield
+            return
+
+        fd = os.open(self.path(user_id), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # 關閉檔案時釋放鎖
+            os.close(fd)
@@ -0,0 +1,96 @@
+"""使用者目前題庫的行程內快取，減少每一題都要寫入 user_states 的 SQLite 寫入。"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserStateCache:
+    """user_states 的 LRU 讀取與寫入快取
+
+    讀取命中且未超過 ttl 秒時不查詢資料庫；寫入只在題庫改變、快取已超過 ttl 秒，
+    或上次寫入 last_active 已超過 touch_interval 秒時才寫入資料庫。
+    多個行程共用資料庫時，其他行程的變更最晚在 ttl 秒後才會被看到，
+    也最晚在 ttl 秒後才會被這個行程的寫入覆蓋回來。
+    """
+
+    def __init__(self, db, max_entries=10000, ttl=300, touch_interval=600):
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self._entries = OrderedDict()  # user_id: [database_name, loaded_at, written_at]
+        self._lock = threading.Lock()
+
+        # 監控數據
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.skipped_writes = 0
+
+    def _store(self, user_id, database_name, loaded_at, written_at):
+        self._entries[user_id] = [database_name, loaded_at, written_at]
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, user_id):
+        """取得使用者目前的題庫"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        database_name = self.db.get_user_state(user_id)
+        with self._lock:
+            # 上次寫入的時間仍然有效，只更新讀取時間
+            written_at = entry[2] if entry is not None else None
+            self._store(user_id, database_name, now, written_at)
+        return database_name
+
+    def update(self, user_id, database_name):
+        """記錄使用者目前的題庫，必要時才寫入資料庫"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if (
+                entry is not None
+                and entry[0] == database_name
+                and now - entry[1] < self.ttl
+                and entry[2] is not None
+                and now - entry[2] < self.touch_interval
+            ):
+                self._entries.move_to_end(user_id)
+                self.skipped_writes += 1
+                return
+            self.writes += 1
+
+        self.db.update_user_state(user_id, database_name)
+        with self._lock:
+            self._store(user_id, database_name, now, now)
+
+    def invalidate(self, user_id=None):
+        """移除單一使用者或全部的快取"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        """快取大小與命中、寫入次數"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "writes": self.writes,
+                "skipped_writes": self.skipped_writes,
+            }
@@ -0,0 +1,236 @@
+"""Webhook 事件派送：依使用者保序的平行派送與背景事件處理工作池。"""
+
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from linebot.v3 import WebhookHandler
+from linebot.v3.webhooks import MessageEvent
+
+logger = logging.getLogger(__name__)
+
+
+def event_key(event):
+    """事件的排序鍵：同一個使用者（或群組、聊天室）的事件必須依序處理"""
+    source = getattr(event, "source", None)
+    for attr in ("user_id", "group_id", "room_id"):
+        key = getattr(source, attr, None)
+        if key:
+            return key
+    # 沒有來源的事件彼此之間沒有順序關係
+    return object()
+
+
+class KeyedExecutor:
+    """同一個鍵的工作依提交順序逐一執行，不同鍵的工作在執行緒池中平行執行
+
+    每個鍵只在有待處理工作時佔用一筆記錄，閒置的鍵會立即移除。
+    """
+
+    def __init__(self, max_workers, thread_name_prefix="keyed-worker"):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix
+        )
+        self._pending = {}  # key: deque[(fn, args, future)]
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        future = Future()
+        with self._lock:
+            queue = self._pending.get(key)
+            if queue is not None:
+                # 這個鍵已經有工作在執行，排在它後面
+                queue.append((fn, args, future))
+                return future
+            self._pending[key] = deque([(fn, args, future)])
+        self._executor.submit(self._drain, key)
+        return future
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._pending[key]
+                if not queue:
+                    del self._pending[key]
+                    return
+                fn, args, future = queue.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def pending_keys(self):
+        with self._lock:
+            return len(self._pending)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class DispatchingWebhookHandler(WebhookHandler):
+    """可以把單一事件派送給已註冊處理函式的 WebhookHandler
+
+    設定 executor 時，所有事件（包括只有一個事件的請求）都交給 executor：
+    不同使用者的事件平行處理，同一個使用者的事件即使分散在同時處理的多個請求中，
+    也依送達的順序處理。
+    """
+
+    def __init__(self, channel_secret, executor=None, **kwargs):
+        super().__init__(channel_secret, **kwargs)
+        self.executor = executor
+
+    def find_handler(self, event):
+        """找出事件對應的處理函式，規則與 WebhookHandler.handle 相同"""
+        func = None
+        if isinstance(event, MessageEvent):
+            key = f"{event.__class__.__name__}_{event.message.__class__.__name__}"
+            func = self._handlers.get(key)
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__)
+        if func is None:
+            func = self._default
+        return func
+
+    def dispatch(self, event, destination=None):
+        """派送單一事件"""
+        func = self.find_handler(event)
+        if func is None:
+            logger.info("No handler of %s and no default handler", type(event).__name__)
+            return
+
+        arg_spec = inspect.getfullargspec(func)
+        if arg_spec.varargs is not None or len(arg_spec.args) == 2:
+            func(event, destination)
+        elif len(arg_spec.args) == 1:
+            func(event)
+        else:
+            func()
+
+    def handle(self, body, signature):
+        payload = self.parser.parse(body, signature, as_payload=True)
+        events = payload.events
+
+        if self.executor is None:
+            for event in events:
+                self.dispatch(event, payload.destination)
+            return
+
+        futures = [
+            self.executor.submit(
+                event_key(event), self.dispatch, event, payload.destination
+            )
+            for event in events
+        ]
+        # 等待所有事件處理完畢，再拋出第一個錯誤
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+
+
+class WebhookWorkerPool:
+    """在背景處理 webhook 事件的有界工作池
+
+    callback 驗證簽章後把事件交給工作池並立即回應 200。
+    事件依使用者分派到 KeyedExecutor，同一個使用者的事件依序處理。
+    待處理事件超過上限時 submit_all 回傳 False，由呼叫端回應錯誤讓 LINE 重送。
+    """
+
+    def __init__(self, handler, workers=4, max_queue=1000):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self._condition = threading.Condition()
+        self._accepting = False
+
+        # 監控數據
+        self.outstanding = 0  # 已接收但尚未處理完畢的事件數
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+
+    def start(self):
+        with self._condition:
+            if self._executor is not None:
+                return
+            self._executor = KeyedExecutor(
+                self.workers, thread_name_prefix="webhook-worker"
+            )
+            self._accepting = True
+
+    def submit_all(self, events, destination=None):
+        """把同一個 webhook 請求中的所有事件交給工作池
+
+        容量不足以放下全部事件時一個都不放，避免部分事件被處理後又被重送。
+        """
+        enqueued_at = time.monotonic()
+        with self._condition:
+            if not self._accepting or self.outstanding + len(events) > self.max_queue:
+                self.rejected += len(events)
+                return False
+            self.outstanding += len(events)
+            self.max_depth = max(self.max_depth, self.outstanding)
+            for event in events:
+                self._executor.submit(
+                    event_key(event), self._process, event, destination, enqueued_at
+                )
+        return True
+
+    def _process(self, event, destination, enqueued_at):
+        with self._condition:
+            self.in_flight += 1
+            self.total_wait += time.monotonic() - enqueued_at
+
+        try:
+            self.handler.dispatch(event, destination)
+        except Exception as e:
+            logger.error("Error processing webhook event: %s", str(e))
+            with self._condition:
+                self.failed += 1
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self.outstanding -= 1
+                self.processed += 1
+                self._condition.notify_all()
+
+    def stats(self):
+        """佇列深度、處理數量與平均等待時間"""
+        with self._condition:
+            started = self.processed + self.in_flight
+            return {
+                "queued": self.outstanding - self.in_flight,
+                "in_flight": self.in_flight,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "max_queue": self.max_queue,
+                "max_depth": self.max_depth,
+                "avg_wait_ms": self.total_wait / started * 1000 if started else 0,
+            }
+
+    def shutdown(self, timeout=30):
+        """停止接收新事件，等待已接收的事件處理完畢"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._accepting = False
+            while self.outstanding and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+        remaining = self.stats()
+        if remaining["queued"] or remaining["in_flight"]:
+            logger.warning("Webhook workers stopped before draining: %s", remaining)
@@ -0,0 +1,220 @@
+"""答題記錄的批次寫入：由單一背景執行緒把多筆寫入合併在同一個交易中提交。"""
+
+import os
+import threading
+import time
+
+
+class WriteBehindQueue:
+    """寫入佇列，每 flush_interval 秒或累積 max_batch 筆時由背景執行緒批次寫入
+
+    write_batch(rows) 必須在單一交易中寫入所有資料列。每筆寫入帶有使用者，
+    讀取前呼叫 wait_user() 可以確保該使用者先前的寫入已經提交。
+    待寫入的資料超過 max_pending 筆時，put() 會等待背景執行緒消化。
+    批次寫入失敗時逐筆重試，重試 max_retries 次仍失敗的資料列記錄錯誤後捨棄，
+    不會擋住之後的寫入。
+    """
+
+    def __init__(
+        self,
+        write_batch,
+        flush_interval=0.05,
+        max_batch=500,
+        max_pending=10000,
+        max_retries=3,
+    ):
+        self.write_batch = write_batch
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._condition = threading.Condition()
+        self._pending = []  # [(seq, user_id, row)]
+        self._writing = []  # 正在寫入中的批次
+        self._user_seq = {}  # user_id: 該使用者最後一筆寫入的序號
+        self._seq = 0
+        self._flushed_seq = 0
+        self._flush_requested = False
+        self._closed = False
+        self._thread = None
+        self._pid = None
+
+        # 監控數據
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+        self.dropped = 0
+        self.max_batch_size = 0
+
+    def _ensure_started(self):
+        # fork 之後子行程沒有背景執行緒，需要重新啟動
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        if self._thread is not None:
+            # 從父行程複製來的待寫入資料由父行程負責寫入
+            self._pending, self._writing = [], []
+            self._user_seq.clear()
+            self._flushed_seq = self._seq
+        self._thread = threading.Thread(
+            target=self._run, name="write-behind", daemon=True
+        )
+        self._pid = os.getpid()
+        self._thread.start()
+
+    def put(self, user_id, row):
+        """加入一筆待寫入的資料列，佇列已關閉時直接同步寫入"""
+        with self._condition:
+            if not self._closed:
+                self._ensure_started()
+                while len(self._pending) >= self.max_pending and not self._closed:
+                    self._condition.wait()
+            if not self._closed:
+                self._seq += 1
+                self._pending.append((self._seq, user_id, row))
+                self._user_seq[user_id] = self._seq
+                if len(self._pending) >= self.max_batch:
+                    self._condition.notify_all()
+                else:
+                    self._condition.notify()
+                return
+
+        self.write_batch([row])
+
+    def pending_rows(self):
+        """尚未提交的資料列（包含正在寫入中的批次）"""
+        with self._condition:
+            return [row for _, _, row in self._writing + self._pending]
+
+    def wait_user(self, user_id, timeout=5):
+        """等待使用者先前的寫入提交，讓讀取看得到自己剛寫入的資料"""
+        with self._condition:
+            seq = self._user_seq.get(user_id)
+            if seq is None or seq <= self._flushed_seq:
+                return True
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self._flushed_seq >= seq, timeout)
+
+    def flush(self, timeout=None):
+        """立即寫入所有待寫入的資料並等待完成"""
+        with self._condition:
+            seq = self._seq
+            if seq <= self._flushed_seq:
+                return True
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self._flushed_seq >= seq, timeout)
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if not self._pending:
+                return None
+
+            # 等到累積足夠的資料、時間到或有讀取需要這些資料
+            deadline = time.monotonic() + self.flush_interval
+            while (
+                len(self._pending) < self.max_batch
+                and not self._flush_requested
+                and not self._closed
+            ):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch = self._pending[: self.max_batch]
+            del self._pending[: self.max_batch]
+            if not self._pending:
+                self._flush_requested = False
+            self._writing = batch
+            self._condition.notify_all()
+            return batch
+
+    def _write_rows(self, batch):
+        """逐筆寫入失敗的批次，回傳捨棄的筆數"""
+        dropped = 0
+        for _, user_id, row in batch:
+            for attempt in range(self.max_retries):
+                if attempt:
+                    time.sleep(self.flush_interval)
+                try:
+                    self.write_batch([row])
+                    break
+                except Exception as e:
+                    error = e
+            else:
+                print(
+                    f"Error dropping answer record of {user_id} "
+                    f"after {self.max_retries} attempts: {error}"
+                )
+                dropped += 1
+        return dropped
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            try:
+                self.write_batch([row for _, _, row in batch])
+                dropped = None
+            except Exception as e:
+                print(f"Error flushing answer records: {e}")
+                # 找出無法寫入的資料列，其他資料列仍然寫入
+                dropped = self._write_rows(batch)
+
+            with self._condition:
+                self._writing = []
+                self._flushed_seq = batch[-1][0]
+                for _, user_id, _ in batch:
+                    if self._user_seq.get(user_id, 0) <= self._flushed_seq:
+                        self._user_seq.pop(user_id, None)
+                self.flushes += 1
+                if dropped is not None:
+                    self.failures += 1
+                    self.dropped += dropped
+                self.rows_written += len(batch) - (dropped or 0)
+                self.max_batch_size = max(self.max_batch_size, len(batch))
+                self._condition.notify_all()
+
+    def stats(self):
+        """待寫入數量與批次寫入統計"""
+        with self._condition:
+            return {
+                "pending": len(self._pending) + len(self._writing),
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "failures": self.failures,
+                "dropped": self.dropped,
+                "max_batch_size": self.max_batch_size,
+                "avg_batch_size": self.rows_written / self.flushes
+                if self.flushes
+                else 0,
+            }
+
+    def close(self, timeout=30):
+        """停止接收新的寫入，寫入所有待寫入的資料後結束背景執行緒"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            thread = self._thread if self._pid == os.getpid() else None
+
+        if thread is not None:
+            thread.join(timeout)
+
+        if thread is not None and thread.is_alive():
+            print("Write-behind queue did not drain before timeout")
+            return
+
+        # 背景執行緒沒有在執行時由呼叫端寫入剩下的資料
+        with self._condition:
+            remaining, self._pending = self._pending, []
+        if remaining:
+            self.write_batch([row for _, _, row in remaining])
+            with self._condition:
+                self._flushed_seq = remaining[-1][0]
+                self._user_seq.clear()
+                self._condition.notify_all()